@@ -0,0 +1,252 @@
+"""
+Shared artifact manager of the Lambdas (images, time and recommendation).
+
+Every service declares the S3 objects it needs on local disk as Artifact
+(bucket, key, local path and, optionally, the expected sha256) and calls
+ensure(), which:
+
+- downloads all the missing artifacts at once, each one split in ranged GETs
+  of PART_SIZE sent in parallel, so a cold start takes as long as the slowest
+  artifact instead of the sum of all of them;
+- pins every part to the ETag of the first one (IfMatch), so an object that
+  changes during the download is never mixed with the previous version;
+- checks the size and the sha256 (declared, or the 'sha256' metadata written
+  by upload_file) before swapping the file in with an atomic rename;
+- with revalidate=True, compares the ETag of the files already on disk with S3
+  and downloads again the stale ones.
+
+All the services share the pooled S3 client of this module.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+S3_BUCKET:str = 'myawzbucket'
+# Size of the ranged GETs of a download
+PART_SIZE:int = int(os.environ.get('ARTIFACT_PART_SIZE', str(8 * 2 ** 20)))
+# Parts downloaded in parallel, across all the artifacts of an ensure() call
+DOWNLOAD_WORKERS:int = int(os.environ.get('ARTIFACT_WORKERS', '16'))
+# Connections of the shared client (downloads, batch image fetches and multipart uploads)
+MAX_POOL_CONNECTIONS:int = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '32'))
+
+# Shared S3 client (S3_ENDPOINT_URL points it to a local stand-in such as moto server)
+s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+                  config=Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={'max_attempts': 5, 'mode': 'adaptive'}))
+
+# Files whose checksum was already verified in this container
+verified:set = set()
+lock = threading.Lock()
+
+class Artifact:
+    """
+    S3 object that a Lambda needs on local disk.
+    """
+
+    def __init__(self, key, path, bucket=S3_BUCKET, sha256=None, optional=False):
+        self.key = key
+        self.path = path
+        self.bucket = bucket
+        self.sha256 = sha256
+        # Opcional: si no existe en S3, ensure() devuelve False en vez de fallar
+        self.optional = optional
+
+    def __repr__(self):
+        return f'Artifact({self.bucket}/{self.key} -> {self.path})'
+
+def is_not_found(error)->bool:
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+def file_sha256(path)->str:
+    """
+    sha256 of a local file, read in blocks.
+    return: hex digest
+    params: path (str)
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def etag_path(path)->str:
+    # ETag de la versión descargada, para revalidar contra S3
+    return f'{path}.etag'
+
+def local_etag(path):
+    try:
+        with open(etag_path(path)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def is_current(artifact, revalidate=False)->bool:
+    """
+    Check whether the local file of an artifact can be used as it is.
+    return: bool
+    params: artifact (Artifact), revalidate (compare the ETag with S3)
+    raise: ClientError for S3 errors other than not found
+    """
+    if not os.path.exists(artifact.path):
+        return False
+    if artifact.sha256 and (artifact.path, artifact.sha256) not in verified:
+        if file_sha256(artifact.path) != artifact.sha256:
+            print(f'{artifact.path} does not match its checksum, downloading it again.')
+            return False
+        verified.add((artifact.path, artifact.sha256))
+    if revalidate:
+        try:
+            etag = s3.head_object(Bucket=artifact.bucket, Key=artifact.key)['ETag']
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+            etag = None
+        if etag != local_etag(artifact.path):
+            print(f'{artifact.path} is stale, downloading it again.')
+            return False
+    return True
+
+def get_range(artifact, tmp_path, start, end, etag=None):
+    """
+    Download bytes start..end (inclusive) of an artifact into its temporary file.
+    return: S3 response (without the body)
+    params: artifact (Artifact), tmp_path (str), start (int), end (int), etag (str, the version of the first part)
+    raise: ClientError (PreconditionFailed if the object changed during the download)
+    """
+    request = {'Bucket': artifact.bucket, 'Key': artifact.key, 'Range': f'bytes={start}-{end}'}
+    if etag is not None:
+        request['IfMatch'] = etag
+    response = s3.get_object(**request)
+    data = response.pop('Body').read()
+    fd = os.open(tmp_path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, start)
+    finally:
+        os.close(fd)
+    return response
+
+def get_first_part(artifact, tmp_path):
+    """
+    Download the first part of an artifact, which also tells its size, ETag and checksum.
+    return: dict {'size', 'etag', 'sha256'}, or None if an optional artifact does not exist
+    params: artifact (Artifact), tmp_path (str)
+    raise: ClientError if a required artifact does not exist
+    """
+    os.makedirs(os.path.dirname(artifact.path) or '.', exist_ok=True)
+    open(tmp_path, 'wb').close()
+    try:
+        response = get_range(artifact, tmp_path, 0, PART_SIZE - 1)
+        size = int(response['ContentRange'].rsplit('/', 1)[1])
+    except ClientError as e:
+        if is_not_found(e) and artifact.optional:
+            os.remove(tmp_path)
+            return None
+        if e.response['Error']['Code'] != 'InvalidRange':
+            raise
+        # Objeto vacío: no admite Range
+        response = s3.head_object(Bucket=artifact.bucket, Key=artifact.key)
+        size = 0
+    os.truncate(tmp_path, size)
+    return {'size': size, 'etag': response['ETag'], 'sha256': artifact.sha256 or response.get('Metadata', {}).get('sha256')}
+
+def finish(artifact, tmp_path, info)->None:
+    """
+    Verify a downloaded artifact and swap it in atomically.
+    return: None
+    params: artifact (Artifact), tmp_path (str), info (dict from get_first_part)
+    raise: ValueError if the size or the checksum do not match
+    """
+    try:
+        if os.path.getsize(tmp_path) != info['size']:
+            raise ValueError(f'{artifact}: expected {info["size"]} bytes, got {os.path.getsize(tmp_path)}')
+        if info['sha256'] and file_sha256(tmp_path) != info['sha256']:
+            raise ValueError(f'{artifact}: checksum mismatch')
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    with lock:
+        # Renombrado atómico: nunca se lee un archivo a medias
+        os.replace(tmp_path, artifact.path)
+        with open(f'{etag_path(artifact.path)}.tmp', 'w') as f:
+            f.write(info['etag'])
+        os.replace(f'{etag_path(artifact.path)}.tmp', etag_path(artifact.path))
+    if info['sha256']:
+        verified.add((artifact.path, info['sha256']))
+
+def ensure(artifacts, revalidate=False)->dict:
+    """
+    Make the artifacts available on local disk, downloading the missing ones concurrently.
+    return: dict {local path: True if available, False for optional artifacts missing in S3}
+    params: artifacts (list of Artifact), revalidate (download again the files whose ETag changed in S3)
+    raise: Exception if a required artifact can't be downloaded or fails verification
+    """
+    available = {}
+    if revalidate:
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_WORKERS, len(artifacts)))) as pool:
+            current = list(pool.map(lambda artifact: is_current(artifact, True), artifacts))
+    else:
+        current = [is_current(artifact) for artifact in artifacts]
+    missing = []
+    for artifact, is_ok in zip(artifacts, current):
+        if is_ok:
+            available[artifact.path] = True
+        else:
+            missing.append(artifact)
+    if not missing:
+        return available
+
+    start_time = time.perf_counter()
+    tmp_paths = {artifact.path: f'{artifact.path}.{os.getpid()}.{threading.get_ident()}.tmp' for artifact in missing}
+    downloaded = []
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+            # La primera parte de cada artefacto da su tamaño; el resto se reparte en paralelo
+            firsts = {pool.submit(get_first_part, artifact, tmp_paths[artifact.path]): artifact for artifact in missing}
+            parts = []
+            for future in as_completed(firsts):
+                artifact = firsts[future]
+                info = future.result()
+                if info is None:
+                    print(f'{artifact} not found in S3.')
+                    # Una copia local de un objeto borrado en S3 ya no vale
+                    for path in (artifact.path, etag_path(artifact.path)):
+                        if os.path.exists(path):
+                            os.remove(path)
+                    available[artifact.path] = False
+                    continue
+                downloaded.append((artifact, info))
+                for start in range(PART_SIZE, info['size'], PART_SIZE):
+                    end = min(start + PART_SIZE, info['size']) - 1
+                    parts.append(pool.submit(get_range, artifact, tmp_paths[artifact.path], start, end, info['etag']))
+            for future in parts:
+                future.result()
+
+        for artifact, info in downloaded:
+            finish(artifact, tmp_paths[artifact.path], info)
+            available[artifact.path] = True
+    except Exception:
+        # Sin restos de descargas fallidas en /tmp
+        for tmp_path in tmp_paths.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+    print(json.dumps({
+        'event': 'artifacts_downloaded',
+        'files': len(downloaded),
+        'bytes': sum(info['size'] for _, info in downloaded),
+        'download_ms': round((time.perf_counter() - start_time) * 1000, 3),
+    }))
+    return available
+
+def upload_file(path, key, bucket=S3_BUCKET)->None:
+    """
+    Upload a local file with its sha256 as metadata, so ensure() verifies it after downloading.
+    return: None
+    params: path (str), key (str), bucket (str)
+    """
+    s3.upload_file(path, bucket, key, ExtraArgs={'Metadata': {'sha256': file_sha256(path)}})
@@ -0,0 +1,117 @@
+import os
+import hashlib
+import threading
+
+# Folder of the cached images in the Lambda env (empty to disable the cache)
+IMAGE_CACHE_PATH:str = os.environ.get('IMAGE_CACHE_PATH', '/tmp/image_cache')
+# Max bytes of cached images on disk
+IMAGE_CACHE_MAX_BYTES:int = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(256 * 2 ** 20)))
+# Fraction of IMAGE_CACHE_MAX_BYTES left after an eviction, so the next scan is many inserts away
+EVICT_TARGET:float = 0.9
+
+# Last ETag seen for each S3 key in this container
+etags:dict = {}
+# Hit/miss counters of this container
+stats:dict = {'hits': 0, 'misses': 0}
+# Running bytes of the cached images (None until the folder is scanned once)
+usage:dict = {'bytes': None}
+# Images of a batch are cached from several threads
+lock = threading.Lock()
+
+def make_key(s3_key, etag)->str:
+    """
+    Content address of an image: the same key with a new ETag is a different entry.
+    return: hex digest
+    params: s3_key (str), etag (str)
+    """
+    return hashlib.sha256(f'{s3_key}|{etag}'.encode()).hexdigest()
+
+def entry_path(key)->str:
+    """
+    Path of a cached image.
+    return: str
+    params: key (str from make_key)
+    """
+    return os.path.join(IMAGE_CACHE_PATH, key)
+
+def get(s3_key):
+    """
+    Cached bytes of the last version seen of an S3 object.
+    return: (ETag, bytes), or (ETag or None, None) if they are not on disk
+    params: s3_key (str)
+    """
+    etag = etags.get(s3_key)
+    if not IMAGE_CACHE_PATH or etag is None:
+        return etag, None
+    path = entry_path(make_key(s3_key, etag))
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        # LRU: la fecha de modificación marca el último uso
+        os.utime(path)
+    except FileNotFoundError:
+        return etag, None
+    return etag, data
+
+def put(s3_key, etag, data)->None:
+    """
+    Store the bytes of an S3 object version and evict the least recently used images.
+    return: None
+    params: s3_key (str), etag (str), data (bytes)
+    """
+    etags[s3_key] = etag
+    if not IMAGE_CACHE_PATH:
+        return
+    os.makedirs(IMAGE_CACHE_PATH, exist_ok=True)
+    path = entry_path(make_key(s3_key, etag))
+    # Escritura atómica: otra invocación nunca lee un archivo a medio escribir
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    with lock:
+        if usage['bytes'] is None:
+            usage['bytes'] = sum(size for size, _, _ in scan())
+        try:
+            # La misma entrada reescrita no suma dos veces
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+        usage['bytes'] += len(data) - replaced
+        # Solo se recorre la carpeta cuando el total pasa del límite
+        if usage['bytes'] > IMAGE_CACHE_MAX_BYTES:
+            evict()
+
+def scan()->list:
+    """
+    Cached images on disk.
+    return: list of (size, mtime, path)
+    params: None
+    """
+    entries = []
+    for entry in os.scandir(IMAGE_CACHE_PATH):
+        if not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_size, stat.st_mtime, entry.path))
+    return entries
+
+def evict()->None:
+    """
+    Remove the least recently used images until the cache is under EVICT_TARGET of IMAGE_CACHE_MAX_BYTES.
+    Called with the lock held; also resyncs the running total with the disk.
+    return: None
+    params: None
+    """
+    entries = scan()
+    total = sum(size for size, _, _ in entries)
+    target = IMAGE_CACHE_MAX_BYTES * EVICT_TARGET
+    entries.sort(key=lambda entry: entry[1])
+    for size, _, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+    usage['bytes'] = total
@@ -1,17 +1,19 @@
 # Libraries
 import json
-# ML Libraries
-import tensorflow as tf
-from tensorflow.keras.preprocessing import image # type: ignore
-from tensorflow.keras.utils import img_to_array # type: ignore
+# ML Libraries: TensorFlow is imported only by the keras backend (load_model_from_s3)
 # Others
 import numpy as np
 from PIL import Image
 import base64
 import pickle
-import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import os
 import io
+import time
+import image_cache
+import preprocess
+from common import artifacts
 
 
 S3_BUCKET: str = 'myawzbucket'
@@ -21,14 +23,46 @@ S3_IMAGES_BUCKET: str = 'mybucketforuploadimages'
 LAMBDA_PATH_MODEL:str = '/tmp/model_images.h5'
 # S3 paths to store files in the Lambda env
 S3_PATH_MODEL:str = 'images/model_images.h5'
+# Inference backend: 'keras' (.h5 with TensorFlow) or 'tflite' (models/image_classification/export_tflite.py)
+MODEL_BACKEND:str = os.environ.get('MODEL_BACKEND', 'keras')
+# TFLite model served by the 'tflite' backend (float16 or int8)
+S3_PATH_TFLITE:str = os.environ.get('TFLITE_MODEL', 'images/model_images_int8.tflite')
+LAMBDA_PATH_TFLITE:str = os.path.join('/tmp', os.path.basename(S3_PATH_TFLITE))
+# Expected sha256 of the served model file (if not set, the 'sha256' metadata of the S3 object is checked)
+MODEL_SHA256:str = os.environ.get('MODEL_SHA256') or None
+# Class labels and calibration of the model, next to it in S3
+S3_PATH_LABELS:str = 'images/class_labels.json'
+LAMBDA_PATH_LABELS:str = '/tmp/class_labels.json'
 
-# Initialize the S3 client
-s3 = boto3.client('s3')
+# Input size of the model
+IMAGE_SIZE:tuple = preprocess.IMAGE_SIZE
+# Clases por defecto si no hay class_labels.json (orden del dataset)
+DEFAULT_LABELS:dict = {'labels': ['jeans', 'sofa', 'tshirt', 'tv'], 'temperature': 1.0, 'confidence_threshold': 0.5}
+# Overrides the confidence_threshold of class_labels.json if set
+CONFIDENCE_THRESHOLD:str = os.environ.get('CONFIDENCE_THRESHOLD', '')
+# Number of most likely classes returned for each image
+TOP_K:int = int(os.environ.get('TOP_K', '3'))
+# Load the model and run the warm-up while the container initializes
+PRELOAD_MODEL:bool = os.environ.get('PRELOAD_MODEL', '1') == '1'
+# Max number of S3 keys in one batch request
+MAX_BATCH_SIZE:int = int(os.environ.get('MAX_BATCH_SIZE', '64'))
+# Threads that download and decode the images of a batch
+FETCH_WORKERS:int = int(os.environ.get('IMAGE_FETCH_WORKERS', '16'))
+# Use the tensors preprocessed by upload.py when they exist
+USE_TENSORS:bool = os.environ.get('USE_TENSORS', '1') == '1'
+
+# Shared pooled S3 client (artifacts.MAX_POOL_CONNECTIONS covers the fetch threads)
+s3 = artifacts.s3
 
 # global variables
 global model
 global status_error
 
+# Model kept in memory across warm invocations
+model_holder:dict = {'model': None, 'labels': None, 'load_ms': None, 'warmup_ms': None}
+# Images without a preprocessed tensor in this container (not asked again)
+missing_tensors:set = set()
+
 def load_model_from_s3(lambda_path,s3_path)->None:
     """
     Load the model from S3 if it's not already loaded.
@@ -38,42 +72,302 @@ def load_model_from_s3(lambda_path,s3_path)->None:
     """
     global model
 
-    # Check if the files exists
-    if not os.path.exists(lambda_path):
-        print("Downloading from S3...")
-        print(f'{S3_BUCKET} --- {s3_path} --- {lambda_path}')
-        s3.download_file(S3_BUCKET, s3_path, lambda_path)
-        print("Model downloaded.")
+    # Download the file if it's not on disk, verifying its checksum
+    artifacts.ensure([artifacts.Artifact(s3_path, lambda_path, S3_BUCKET, sha256=MODEL_SHA256)])
     # Load the model
+    import tensorflow as tf
     model = tf.keras.models.load_model(lambda_path)
     print("Model loaded.")
+    return model
 
-def load_image_from_s3(file_name):
+class TFLiteModel:
     """
-    Load the image from S3 
-    return: model
-    params: None
+    TFLite interpreter with the call signature of a keras model: model(x, training=False).
+    """
+
+    def __init__(self, path):
+        # tflite-runtime en la imagen ligera; TensorFlow completo si está instalado
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite.python.interpreter import Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=os.cpu_count())
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def __call__(self, x, training=False):
+        """
+        Class probabilities of a batch.
+        return: np.array (n, n_classes)
+        params: x (np.array (n, 244, 244, 3) float32), training (ignored)
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        # Redimensionar solo cuando cambia el tamaño del lote
+        if x.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, x.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = x.shape[0]
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+def load_tflite_from_s3(lambda_path, s3_path)->TFLiteModel:
+    """
+    Load the TFLite model from S3 if it's not already on disk.
+    return: TFLiteModel
+    params: lambda_path (str), s3_path (str)
     raise: Exception if the model file does not exist in S3
     """
-    #s3_path = file_name
-    img_path = '/tmp/img.jpg'
-    print("Downloading THE IMAGE from S3...")
-    # Check if the files exists
-    if not os.path.exists(img_path):
-        print("On it...")
-        print(f'S3 ROUTE: {S3_IMAGES_BUCKET}/{file_name} \n LAMBDA_PATH: {img_path}')
-        #print(f'{S3_BUCKET} --- {s3_path} --- {lambda_path}')
-        #s3.download_file(S3_BUCKET, s3_path, lambda_path)
-        s3.download_file(S3_IMAGES_BUCKET, file_name, img_path)
-        print("Files downloaded.")
-    print("Image downloaded.")
-    
-    img = image.load_img(img_path, target_size=(244, 244))
-    
-    print("Image loaded.")
+    artifacts.ensure([artifacts.Artifact(s3_path, lambda_path, S3_BUCKET, sha256=MODEL_SHA256)])
+    loaded_model = TFLiteModel(lambda_path)
+    print(f"TFLite model {s3_path} loaded.")
+    return loaded_model
+
+def model_artifacts()->list:
+    """
+    Files of the served model: the model of MODEL_BACKEND and its optional class labels.
+    return: list of artifacts.Artifact
+    params: None
+    """
+    if MODEL_BACKEND == 'tflite':
+        model_artifact = artifacts.Artifact(S3_PATH_TFLITE, LAMBDA_PATH_TFLITE, S3_BUCKET, sha256=MODEL_SHA256)
+    else:
+        model_artifact = artifacts.Artifact(S3_PATH_MODEL, LAMBDA_PATH_MODEL, S3_BUCKET, sha256=MODEL_SHA256)
+    return [model_artifact, artifacts.Artifact(S3_PATH_LABELS, LAMBDA_PATH_LABELS, S3_BUCKET, optional=True)]
+
+def load_labels_from_s3()->dict:
+    """
+    Load the class labels and the calibration of the model.
+    return: dict {'labels': list of str, 'temperature': float, 'confidence_threshold': float}
+    params: None
+    raise: Exception if the file exists but can't be read
+    """
+    if artifacts.ensure(model_artifacts()[1:])[LAMBDA_PATH_LABELS]:
+        with open(LAMBDA_PATH_LABELS) as f:
+            labels = {**DEFAULT_LABELS, **json.load(f)}
+    else:
+        print(f"{S3_PATH_LABELS} not found, using the default labels.")
+        labels = dict(DEFAULT_LABELS)
+    if CONFIDENCE_THRESHOLD:
+        labels['confidence_threshold'] = float(CONFIDENCE_THRESHOLD)
+    return labels
+
+def calibrate(probabilities, temperature=1.0):
+    """
+    Temperature scaling of softmax outputs: softmax(log(p) / T) equals softmax(logits / T).
+    return: np.array (n, n_classes)
+    params: probabilities (np.array (n, n_classes)), temperature (float)
+    """
+    if temperature == 1.0:
+        return probabilities
+    logits = np.log(np.clip(probabilities, 1e-12, None)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=1, keepdims=True)
+
+def predict(loaded_model, img_array):
+    """
+    Class probabilities of a batch of processed images.
+    return: np.array (n, n_classes)
+    params: loaded_model (keras model), img_array (np.array (n, 244, 244, 3))
+    """
+    # Llamar al modelo directamente evita el overhead de model.predict en lotes pequeños
+    return np.asarray(loaded_model(img_array, training=False))
+
+def get_model():
+    """
+    Get the model, loading it and running a warm-up inference only once per container.
+    return: keras model
+    params: None
+    raise: Exception if the model can't be downloaded or loaded
+    """
+    global model
+    if model_holder['model'] is None:
+        start_time = time.perf_counter()
+        # Modelo y etiquetas a la vez; las copias de /tmp que cambiaron en S3 se descargan de nuevo
+        artifacts.ensure(model_artifacts(), revalidate=True)
+        if MODEL_BACKEND == 'tflite':
+            loaded_model = load_tflite_from_s3(LAMBDA_PATH_TFLITE, S3_PATH_TFLITE)
+        else:
+            loaded_model = load_model_from_s3(LAMBDA_PATH_MODEL, S3_PATH_MODEL)
+        load_ms = (time.perf_counter() - start_time) * 1000
+
+        labels = load_labels_from_s3()
+
+        # Warm-up: el trazado del grafo no lo paga el primer usuario
+        start_time = time.perf_counter()
+        output = predict(loaded_model, np.zeros((1, *IMAGE_SIZE, 3), dtype=np.float32))
+        warmup_ms = (time.perf_counter() - start_time) * 1000
+        if output.shape[1] != len(labels['labels']):
+            raise ValueError(f"The model has {output.shape[1]} outputs but {S3_PATH_LABELS} has {len(labels['labels'])} labels")
+
+        model = loaded_model
+        model_holder.update({'model': loaded_model, 'labels': labels, 'load_ms': load_ms, 'warmup_ms': warmup_ms})
+        print(json.dumps({'event': 'model_loaded', 'backend': MODEL_BACKEND, 'load_ms': round(load_ms, 3), 'warmup_ms': round(warmup_ms, 3)}))
+    return model_holder['model']
+
+def fetch_image_bytes(file_name)->bytes:
+    """
+    Get the bytes of an image in S3, from the local cache if its ETag did not change.
+    return: bytes
+    params: file_name (S3 key in S3_IMAGES_BUCKET)
+    raise: Exception if the image does not exist in S3
+    """
+    etag, data = image_cache.get(file_name)
+    request = {'Bucket': S3_IMAGES_BUCKET, 'Key': file_name}
+    # Con la copia local, S3 solo devuelve el cuerpo si la imagen cambió
+    if data is not None:
+        request['IfNoneMatch'] = etag
+    try:
+        response = s3.get_object(**request)
+    except ClientError as e:
+        if data is not None and e.response['Error']['Code'] in ('304', 'NotModified'):
+            image_cache.stats['hits'] += 1
+            return data
+        raise
+    data = response['Body'].read()
+    image_cache.put(file_name, response['ETag'], data)
+    image_cache.stats['misses'] += 1
+    return data
+
+def load_tensor_from_s3(file_name):
+    """
+    Load the tensor preprocessed at upload time of an image.
+    return: np.array (244, 244, 3) uint8, or None if the image has no tensor
+    params: file_name (S3 key in S3_IMAGES_BUCKET)
+    raise: Exception if the tensor exists but can't be read
+    """
+    if not USE_TENSORS or file_name in missing_tensors or not preprocess.has_tensor(file_name):
+        return None
+    try:
+        return preprocess.decode_tensor(fetch_image_bytes(preprocess.tensor_key(file_name)))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        missing_tensors.add(file_name)
+        return None
 
+def load_image_from_s3(file_name):
+    """
+    Load the image from S3, as its preprocessed tensor if it has one (no decode nor resize)
+    return: PIL image or np.array (244, 244, 3) uint8
+    params: file_name (S3 key in S3_IMAGES_BUCKET)
+    raise: Exception if the image does not exist in S3
+    """
+    print(f'S3 ROUTE: {S3_IMAGES_BUCKET}/{file_name}')
+    img = load_tensor_from_s3(file_name)
+    if img is None:
+        img = preprocess.decode_image(fetch_image_bytes(file_name))
+    print(f"Image loaded. Cache {image_cache.stats}")
     return img
 
+def load_batch_from_s3(file_names):
+    """
+    Download and decode several images concurrently into one preallocated batch.
+    return: (batch float32 (n_ok, 244, 244, 3) scaled to [0, 1], positions of the loaded images, dict {position: error})
+    params: file_names (list of S3 keys in S3_IMAGES_BUCKET)
+    """
+    batch = np.empty((len(file_names), *IMAGE_SIZE, 3), dtype=np.float32)
+
+    def load(position):
+        # Cada hilo escribe su imagen directamente en su fila del lote
+        batch[position] = np.asarray(load_image_from_s3(file_names[position]), dtype=np.float32)
+
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(file_names))) as pool:
+        futures = [pool.submit(load, position) for position in range(len(file_names))]
+    errors = {position: str(future.exception()) for position, future in enumerate(futures) if future.exception()}
+    loaded = [position for position in range(len(file_names)) if position not in errors]
+    if errors:
+        batch = batch[loaded]
+    # Misma normalización que process_image
+    np.divide(batch, 255.0, out=batch)
+    return batch, loaded, errors
+
+def prediction_record(probabilities, top_k=TOP_K)->dict:
+    """
+    Class, confidence, top-k classes and probabilities of one image.
+    return: dict
+    params: probabilities (calibrated np.array (n_classes,)), top_k (int)
+    """
+    labels = model_holder['labels']
+    order = np.argsort(-probabilities, kind='stable')[:top_k]
+    confidence = float(probabilities[order[0]])
+    return {
+        'prediction': labels['labels'][order[0]],
+        'confidence': confidence,
+        # Las predicciones dudosas se envían al pipeline más pesado
+        'low_confidence': confidence < labels['confidence_threshold'],
+        'top_k': [{'label': labels['labels'][i], 'probability': float(probabilities[i])} for i in order],
+        'probabilities': dict(zip(labels['labels'], probabilities.tolist())),
+    }
+
+def is_valid_batch(input_data):
+    """
+    Validate a list of S3 keys.
+    return: True if the input is valid, else False and status_error holds the error response
+    params: input_data (list of str)
+    """
+    global status_error
+
+    if not input_data or not all(key and isinstance(key, str) for key in input_data) or len(input_data) > MAX_BATCH_SIZE:
+        status_error = {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. Provide a list of 1 to {MAX_BATCH_SIZE} S3 keys.'})
+        }
+        return False
+    status_error = None
+    return True
+
+def handle_batch(file_names, top_k=TOP_K):
+    """
+    Classify several images with one model call.
+    return: JSON response with one result per key, in order
+    params: file_names (list of S3 keys), top_k (int)
+    """
+    if not is_valid_batch(file_names):
+        return status_error
+    try:
+        cold = model_holder['model'] is None
+        loaded_model = get_model()
+
+        start_time = time.perf_counter()
+        batch, loaded, errors = load_batch_from_s3(file_names)
+        fetch_ms = (time.perf_counter() - start_time) * 1000
+
+        start_time = time.perf_counter()
+        probabilities = predict(loaded_model, batch) if len(loaded) else np.empty((0, len(model_holder['labels']['labels'])))
+        probabilities = calibrate(probabilities, model_holder['labels']['temperature'])
+        inference_ms = (time.perf_counter() - start_time) * 1000
+
+        results = [None] * len(file_names)
+        for position, row in zip(loaded, probabilities):
+            results[position] = {'key': file_names[position], **prediction_record(row, top_k)}
+        for position, error in errors.items():
+            print(f"Error with {file_names[position]}: {error}")
+            results[position] = {'key': file_names[position], 'error': error}
+        print(json.dumps({
+            'event': 'batch_prediction',
+            'cold': cold,
+            'model_load_ms': round(model_holder['load_ms'], 3) if cold else 0,
+            'images': len(loaded),
+            'errors': len(errors),
+            'fetch_ms': round(fetch_ms, 3),
+            'inference_ms': round(inference_ms, 3),
+            'low_confidence': sum(result.get('low_confidence', False) for result in results),
+        }))
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'predictions': results})
+        }
+
+    except Exception as e:
+        print(f"Error: {e}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps({'error': str(e)})
+        }
+
 def is_valid_data(input_data):
     """
     Validate the input data.
@@ -103,7 +397,8 @@ def load_test_image():
     s3.download_file(S3_IMAGES_BUCKET, 'pants.jpg', '/tmp/pants.jpg')
     print("Image downloaded.")
     img_path = '/tmp/pants.jpg'
-    test_image = image.load_img(img_path, target_size=(244, 244))
+    with open(img_path, 'rb') as f:
+        test_image = preprocess.decode_image(f.read())
     print("Image loaded.")
 
     return test_image
@@ -124,23 +419,24 @@ def process_image(image_input):
     params: image_path (str)
     raise: Exception if the image is not found
     """
-    # Convert the image to an array
-    # tf.keras.utils.img_to_array(img, data_format=None, dtype=None)
-
-    img_array = img_to_array(image_input)
+    # Convert the image to an array (same as keras img_to_array)
+    img_array = np.asarray(image_input, dtype=np.float32)
     # Expand the dimensions of the image
     img_array = np.expand_dims(img_array, axis=0)
     # Normalize the image
     img_array = img_array / 255.0
     return img_array
 
-def make_prediction(img_array):
-    # Diccionario de clases (ajusta según el orden de tu dataset)
-    class_labels = ['jeans', 'sofa', 'tshirt', 'tv']
+def make_prediction(img_array, top_k=TOP_K):
+    """
+    Classify one processed image.
+    return: dict from prediction_record
+    params: img_array (np.array (1, 244, 244, 3)), top_k (int)
+    """
     # Realizar predicción
-    predictions = model.predict(img_array)
-    predicted_class = class_labels[np.argmax(predictions)]
-    return predicted_class
+    predictions = predict(get_model(), img_array)
+    predictions = calibrate(predictions, model_holder['labels']['temperature'])
+    return prediction_record(predictions[0], top_k)
 
 def lambda_handler(event, _):
     """
@@ -149,10 +445,8 @@ def lambda_handler(event, _):
     params: event (API Gateway input), context (Lambda context)
     raise: Exception if the input data is invalid or the model fails
     """
-    global model
     global status_error
 
-    class_labels = ['jeans', 'sofa', 'tshirt', 'tv']
     #test_image = load_test_image()
     # Try to get the input data from the event
     try:
@@ -160,6 +454,9 @@ def lambda_handler(event, _):
         body = event.get("body")
         parsed_body = json.loads(body)
         input_data = parsed_body.get("data")
+        top_k = parsed_body.get("top_k", TOP_K)
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+            raise ValueError('top_k must be a positive integer')
         print('Extracting data...')
         print(input_data)
 
@@ -169,6 +466,10 @@ def lambda_handler(event, _):
             'statusCode': 400,
             'body': json.dumps({'ERROR': f'Invalid input. No input data: {e}'})
         }
+
+    # A list of S3 keys is classified as one batch
+    if isinstance(input_data, list):
+        return handle_batch(input_data, top_k)
     
     # Try to download the image from S3
     try:
@@ -183,20 +484,29 @@ def lambda_handler(event, _):
         }
 
     try:
-        print("Downloading model...")
-        load_model_from_s3(LAMBDA_PATH_MODEL, S3_PATH_MODEL)
+        # Model loaded once per container
+        cold = model_holder['model'] is None
+        get_model()
         # preprocesar la imagen
         print('Processing image...')
         img_array = process_image(selected_image)
         # Realizar predicción
         print('Making prediction...')
-        predictions = model.predict(img_array)
-        predicted_class = class_labels[np.argmax(predictions)]
-        print(f"Predicted class: {predicted_class}")
+        start_time = time.perf_counter()
+        prediction = make_prediction(img_array, top_k)
+        inference_ms = (time.perf_counter() - start_time) * 1000
+        print(f"Predicted class: {prediction['prediction']} ({prediction['confidence']:.3f})")
+        print(json.dumps({
+            'event': 'prediction',
+            'cold': cold,
+            'model_load_ms': round(model_holder['load_ms'], 3) if cold else 0,
+            'inference_ms': round(inference_ms, 3),
+            'low_confidence': prediction['low_confidence'],
+        }))
 
         return {
             'statusCode': 200,
-            'body': json.dumps({'prediction': predicted_class})
+            'body': json.dumps(prediction)
         }
     
     except Exception as e:
@@ -204,4 +514,11 @@ def lambda_handler(event, _):
         return {
             'statusCode': 500,
             'body': [json.dumps({'error': str(e)}), 'Life is hard buddy']
-        }
\ No newline at end of file
+        }
+
+# Cargar el modelo durante el init del contenedor; si falla, se reintenta en la primera petición
+if PRELOAD_MODEL:
+    try:
+        get_model()
+    except Exception as e:
+        print(f"Model preload failed: {e}")
@@ -0,0 +1,73 @@
+import io
+import re
+import numpy as np
+from PIL import Image
+
+# Input size of the model
+IMAGE_SIZE:tuple = (244, 244)
+# Ready-to-infer tensors are stored as tensors/<key>.npy next to the uploaded images
+TENSOR_PREFIX:str = 'tensors/'
+# Keys written by upload.py: sha256 of the content plus the extension
+CONTENT_KEY = re.compile(r'^[0-9a-f]{64}\.[a-z]+$')
+
+def decode_image(data):
+    """
+    Decode an image from memory like keras load_img(target_size=IMAGE_SIZE).
+    return: PIL image (RGB, IMAGE_SIZE)
+    params: data (bytes-like)
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img.resize(IMAGE_SIZE[::-1], Image.NEAREST)
+
+def tensor_key(s3_key)->str:
+    """
+    S3 key of the preprocessed tensor of an image.
+    return: str
+    params: s3_key (str)
+    """
+    return f'{TENSOR_PREFIX}{s3_key}.npy'
+
+def has_tensor(s3_key)->bool:
+    """
+    Only content-addressed images can have a tensor: their content never changes, so the tensor is never stale.
+    return: bool
+    params: s3_key (str)
+    """
+    return bool(CONTENT_KEY.match(s3_key))
+
+def image_array(data):
+    """
+    Decode and resize an image once.
+    return: np.array (244, 244, 3) uint8
+    params: data (bytes-like of the original image)
+    raise: ValueError if PIL can't decode it (truncated or corrupt file with a valid signature)
+    """
+    try:
+        return np.asarray(decode_image(data), dtype=np.uint8)
+    except (Image.UnidentifiedImageError, OSError) as e:
+        # La firma del archivo no garantiza que se pueda decodificar
+        raise ValueError(f'The file is not a valid image: {e}') from e
+
+def encode_tensor(array)->bytes:
+    """
+    Serialize a decoded image as a .npy.
+    return: bytes of a uint8 (244, 244, 3) .npy
+    params: array (np.array from image_array)
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def decode_tensor(data):
+    """
+    Read a tensor written by encode_tensor.
+    return: np.array (244, 244, 3) uint8
+    params: data (bytes)
+    raise: ValueError if it is not a uint8 tensor of the model input size
+    """
+    array = np.load(io.BytesIO(data), allow_pickle=False)
+    if array.dtype != np.uint8 or array.shape != (*IMAGE_SIZE, 3):
+        raise ValueError(f'Unexpected tensor {array.dtype} {array.shape}')
+    return array
@@ -1,60 +1,49 @@
 import json
 import base64
-import boto3
-from botocore.exceptions import NoCredentialsError
+from botocore.exceptions import NoCredentialsError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
 import time
-# Others
-import cgi
-from io import BytesIO
-#from requests_toolbelt.multipart import decoder
+import multipart
+from common import artifacts
 
-# Initialize the S3 client
-s3 = boto3.client('s3')
 BUCKET_NAME = 'mybucketforuploadimages'  # Replace with your actual bucket name
+# Bodies above this size go through S3 multipart upload
+MULTIPART_THRESHOLD:int = int(os.environ.get('MULTIPART_THRESHOLD', str(8 * 2 ** 20)))
+# Size of each part (S3 minimum is 5 MB, except for the last one)
+MULTIPART_PART_SIZE:int = max(int(os.environ.get('MULTIPART_PART_SIZE', str(8 * 2 ** 20))), 5 * 2 ** 20)
+# Parts uploaded in parallel
+UPLOAD_WORKERS:int = int(os.environ.get('UPLOAD_WORKERS', '8'))
+# Store a ready-to-infer tensor (uint8 244x244x3 .npy) next to every uploaded image
+PREPROCESS_ON_UPLOAD:bool = os.environ.get('PREPROCESS_ON_UPLOAD', '1') == '1'
+# Classify every upload in the same invocation (fused upload+classify Lambda); '?classify=1' enables it per request
+CLASSIFY_ON_UPLOAD:bool = os.environ.get('CLASSIFY_ON_UPLOAD', '0') == '1'
+# MIME type and extension of the accepted images, by their first bytes
+IMAGE_SIGNATURES:tuple = (
+    (b'\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    (b'GIF87a', 'image/gif', '.gif'),
+    (b'GIF89a', 'image/gif', '.gif'),
+    (b'BM', 'image/bmp', '.bmp'),
+    (b'II*\x00', 'image/tiff', '.tiff'),
+    (b'MM\x00*', 'image/tiff', '.tiff'),
+)
 
-def do_stuff(multipart_data):
-    # Initialize variables to hold the file and metadata
-    file_content = None
-    file_name = None
-    file_type = None
+# Shared pooled S3 client (S3_ENDPOINT_URL points it to a local stand-in such as moto server)
+s3 = artifacts.s3
 
-    # Now you can access the file and metadata from the parsed data
-    for part in multipart_data.parts:
-        content_disposition = part.headers.get('Content-Disposition', '')
-        if 'file' in content_disposition:
-            # This is the file part
-            file_content = part.content
-            file_name = part.headers.get('Content-Disposition').split('filename="')[1].split('"')[0]
-            file_type = part.headers.get('Content-Type')
-            print(f"Received file: {file_name}, Type: {file_type}")
-
-            # Process the file (e.g., save it to S3 or store it locally)
-        elif 'fileName' in content_disposition:
-            # This is the file name metadata
-            file_name_metadata = part.content.decode('utf-8')
-            print(f"Received file name metadata: {file_name_metadata}")
-        elif 'fileType' in content_disposition:
-            # This is the file type metadata
-            file_type_metadata = part.content.decode('utf-8')
-            print(f"Received file type metadata: {file_type_metadata}")
-    return file_content
+if CLASSIFY_ON_UPLOAD:
+    # El modelo se carga durante el init del contenedor (main.PRELOAD_MODEL)
+    import main
 
 def extract_file_from_body(event):
     """
     Helper function to extract file content and metadata from the raw event body.
-    Returns file_content, file_name, file_type, file_name_metadata, and file_type_metadata.
+    Returns file_content (memoryview of the decoded body), file_name, file_type, file_name_metadata, and file_type_metadata.
     """
-    # Check if the body is base64 encoded (API Gateway might encode the body if binary data is sent)
-    if event['isBase64Encoded']:
-        body = base64.b64decode(event['body'])
-    else:
-        body = event['body'].encode('utf-8')
-
-    # Create a BytesIO object from the raw binary body (useful for cgi parsing)
-    body_io = BytesIO(body)
-
-    # Parse the multipart form data
-    form = cgi.FieldStorage(fp=body_io, headers=event['headers'], environ={'REQUEST_METHOD': 'POST'})
+    # Parse the multipart form data (base64 bodies are decoded in chunks)
+    form = multipart.parse(event)
 
     file_content = None
     file_name = None
@@ -65,25 +54,193 @@ def extract_file_from_body(event):
     # Check for the file field in the form data
     if "file" in form:
         file_field = form["file"]
-        file_content = file_field.file.read()  # Get the binary file content
-        file_name = file_field.filename        # Get the filename
-        file_type = file_field.type            # Get the file type (MIME type)
+        file_content = file_field.data             # Binary file content, without copying it
+        file_name = file_field.filename            # Get the filename
+        file_type = file_field.content_type        # Get the file type (MIME type)
         print(f"Received file: {file_name}, Type: {file_type}")
 
     # Check for file name and type metadata
-    file_name_metadata = form.getvalue("fileName", None)
-    file_type_metadata = form.getvalue("fileType", None)
-    if file_name_metadata:
+    if "fileName" in form:
+        file_name_metadata = form["fileName"].text()
         print(f"Received file name metadata: {file_name_metadata}")
-    if file_type_metadata:
+    if "fileType" in form:
+        file_type_metadata = form["fileType"].text()
         print(f"Received file type metadata: {file_type_metadata}")
 
     return file_content, file_name, file_type, file_name_metadata, file_type_metadata
 
+def detect_image_type(data):
+    """
+    MIME type of an image from its magic bytes (the Content-Type sent by the client is not trusted).
+    return: (mime type, extension), or (None, None) if it is not a supported image
+    params: data (bytes-like)
+    """
+    header = bytes(data[:12])
+    for signature, mime_type, extension in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mime_type, extension
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp', '.webp'
+    return None, None
+
+def content_key(data, extension)->str:
+    """
+    Content-addressed S3 key: the same image always gets the same key, different images never collide.
+    return: str
+    params: data (bytes-like), extension (str)
+    """
+    return f'{hashlib.sha256(data).hexdigest()}{extension}'
+
+def object_exists(key, s3_client=None)->bool:
+    """
+    Check whether an object is already in the bucket.
+    return: bool
+    params: key (str), s3_client (boto3 client, default: the module client)
+    raise: ClientError for errors other than not found
+    """
+    try:
+        (s3_client or s3).head_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+def multipart_upload(data, key, content_type, s3_client=None)->None:
+    """
+    Upload a large body with S3 multipart upload, sending the parts in parallel.
+    return: None
+    params: data (memoryview), key (str), content_type (str), s3_client (boto3 client, default: the module client)
+    raise: Exception if a part fails (the multipart upload is aborted)
+    """
+    s3_client = s3_client or s3
+    upload_id = s3_client.create_multipart_upload(Bucket=BUCKET_NAME, Key=key, ContentType=content_type)['UploadId']
+
+    def upload_part(part_number):
+        start = (part_number - 1) * MULTIPART_PART_SIZE
+        part = data[start:start + MULTIPART_PART_SIZE]
+        response = s3_client.upload_part(Bucket=BUCKET_NAME, Key=key, UploadId=upload_id, PartNumber=part_number,
+                                         Body=multipart.PartReader(part), ContentLength=len(part))
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    n_parts = -(-len(data) // MULTIPART_PART_SIZE)
+    try:
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, n_parts)) as executor:
+            parts = list(executor.map(upload_part, range(1, n_parts + 1)))
+        s3_client.complete_multipart_upload(Bucket=BUCKET_NAME, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        # Sin abortar, las partes subidas se cobrarían indefinidamente
+        s3_client.abort_multipart_upload(Bucket=BUCKET_NAME, Key=key, UploadId=upload_id)
+        raise
+
+def store_image(data, s3_client=None):
+    """
+    Store an image under its content hash, skipping the upload if it is already in the bucket.
+    return: (key, uploaded bool)
+    params: data (memoryview or bytes), s3_client (boto3 client, default: the module client)
+    raise: ValueError if the data is not a supported image, Exception if the upload fails
+    """
+    data = memoryview(data)
+    content_type, extension = detect_image_type(data)
+    if content_type is None:
+        raise ValueError('The file is not a supported image (JPEG, PNG, GIF, BMP, TIFF or WebP).')
+    key = content_key(data, extension)
+    if object_exists(key, s3_client):
+        return key, False
+    if len(data) > MULTIPART_THRESHOLD:
+        multipart_upload(data, key, content_type, s3_client)
+    else:
+        (s3_client or s3).put_object(
+            Bucket=BUCKET_NAME,
+            Key=key,
+            Body=multipart.PartReader(data),  # The binary image data, read straight from the body
+            ContentLength=len(data),
+            ContentType=content_type,
+        )
+    return key, True
+
+def store_tensor(key, data, uploaded=True, image=None, s3_client=None):
+    """
+    Decode and resize an uploaded image once and store its tensor next to it, for main.py.
+    return: (tensor key, stored bool)
+    params: key (S3 key of the image), data (bytes-like of the image), uploaded (False if the image was already in the bucket),
+            image (np.array from preprocess.image_array if already decoded), s3_client (boto3 client, default: the module client)
+    raise: Exception if the image can't be decoded or the upload fails
+    """
+    # numpy y PIL solo hacen falta con el preprocesado activado
+    import preprocess
+    s3_client = s3_client or s3
+    tensor_key = preprocess.tensor_key(key)
+    if not uploaded and object_exists(tensor_key, s3_client):
+        return tensor_key, False
+    if image is None:
+        image = preprocess.image_array(data)
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=tensor_key, Body=preprocess.encode_tensor(image),
+                         ContentType='application/octet-stream')
+    return tensor_key, True
+
+def persist_image(data, image=None, s3_client=None):
+    """
+    Store an uploaded image and, with PREPROCESS_ON_UPLOAD, its tensor.
+    return: dict {'key', 'uploaded', 'tensor_stored'}
+    params: data (bytes-like of the image), image (np.array from preprocess.image_array if already decoded),
+            s3_client (boto3 client, default: the module client)
+    raise: ValueError if the data is not a supported image, Exception if the upload fails
+    """
+    key, uploaded = store_image(data, s3_client)
+    tensor_stored = False
+    if PREPROCESS_ON_UPLOAD:
+        try:
+            _, tensor_stored = store_tensor(key, data, uploaded, image, s3_client)
+        except Exception as e:
+            # main.py decodifica el original si no hay tensor
+            print(f"Error preprocessing {key}: {e}")
+    return {'key': key, 'uploaded': uploaded, 'tensor_stored': tensor_stored}
+
+def upload_and_classify(data, top_k=None, s3_client=None)->dict:
+    """
+    Classify the uploaded bytes with the model holder of main.py while they are stored in S3.
+    return: dict with the key, uploaded, tensor_stored and the prediction of main.prediction_record
+    params: data (bytes-like of the image), top_k (int, default: main.TOP_K), s3_client (boto3 client, default: the module client)
+    raise: ValueError if the data is not a supported image, Exception if the upload or the model fails
+    """
+    import main
+    import preprocess
+    if detect_image_type(data)[0] is None:
+        raise ValueError('The file is not a supported image (JPEG, PNG, GIF, BMP, TIFF or WebP).')
+    # Una sola decodificación para la inferencia y para el tensor
+    image = preprocess.image_array(data)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # La subida a S3 se solapa con la inferencia; la Lambda se congela al responder,
+        # así que se espera a que termine antes de devolver la predicción
+        storing = executor.submit(persist_image, data, image, s3_client)
+        try:
+            prediction = main.make_prediction(main.process_image(image), top_k or main.TOP_K)
+        except ValueError as e:
+            # Los ValueError de subida son imágenes no soportadas (415); estos son del modelo
+            raise RuntimeError(f'Classification failed: {e}') from e
+        stored = storing.result()
+    return {**stored, **prediction}
+
+def wants_classification(event)->bool:
+    """
+    Check whether an upload must be classified too (CLASSIFY_ON_UPLOAD or ?classify=1).
+    return: bool
+    params: event (API Gateway input)
+    """
+    params = event.get('queryStringParameters') or {}
+    return CLASSIFY_ON_UPLOAD or str(params.get('classify', '')).lower() in ('1', 'true')
+
 def lambda_handler(event, context):
     # Extract file and metadata using the helper function
     try:
         file_content, file_name, file_type, file_name_metadata, file_type_metadata = extract_file_from_body(event)
+    except ValueError as e:
+        # Cuerpo mal formado (base64 inválido o multipart roto): error del cliente
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'message': f'Invalid request body: {str(e)}'})
+        }
     except Exception as e:
         return {
             'statusCode': 500,
@@ -92,31 +249,27 @@ def lambda_handler(event, context):
 
     if file_content:
         try:
-            # Decode the image data
-            #image_data = base64.b64decode(file_content)
-
-            # Define a file name (you can make it dynamic if needed)
-            file_name = f'uploaded_image_{int(time.time())}.jpg'  # Change the name or make it dynamic
-
-            # Set the parameters for the S3 upload
-            s3_params = {
-                'Bucket': BUCKET_NAME,
-                'Key': file_name,  # The file name in S3
-                'Body': file_content,  # The binary image data
-                'ContentType': 'image/jpeg',  # Content type for the image
-            }
-
-            # Upload the image to S3
-            s3.put_object(**s3_params)
+            start_time = time.perf_counter()
+            if wants_classification(event):
+                # Subida y clasificación en una sola invocación
+                result = upload_and_classify(file_content)
+                body = result
+            else:
+                # Upload the image to S3 under its content hash
+                result = persist_image(file_content)
+                body = result['key']
+            print(json.dumps({'event': 'upload', 'key': result['key'], 'bytes': len(file_content), 'uploaded': result['uploaded'],
+                              'tensor_stored': result['tensor_stored'], 'classified': 'prediction' in result,
+                              'upload_ms': round((time.perf_counter() - start_time) * 1000, 3)}))
 
             return {
                 'statusCode': 200,
-                'body': json.dumps(file_name)
+                'body': json.dumps(body)
             }
-        except Exception as e:
+        except ValueError as e:
             return {
-                'statusCode': 500,
-                'body': json.dumps({'message': f'Error In that part uploading the image to S3: {str(e)}'})
+                'statusCode': 415,
+                'body': json.dumps({'message': str(e)})
             }
         except NoCredentialsError:
             return {
@@ -133,4 +286,3 @@ def lambda_handler(event, context):
             'statusCode': 400,
             'body': json.dumps({'message': 'No image data found in the request body.'})
         }
-    
@@ -0,0 +1,299 @@
+"""
+Pickle-free artifact bundle of the recommendation Lambda.
+
+The notebook artifacts (frame.pkl and top_k_neighbors.pkl) are converted
+offline into a folder of .npy files that the Lambda memory-maps:
+
+    neighbors.npy             int32 (N, k) top-k neighbors of every product
+    neighbor_scores.npy       float32 (N, k) cosine similarity with each neighbor
+    ratings.npy ...           float64 (N,) numeric columns of the response
+    name_offsets.npy          int64 (N + 1,) string table of each text column:
+    name_bytes.npy            uint8 UTF-8 bytes of row i are bytes[offsets[i]:offsets[i + 1]]
+    name_order.npy            int32 (N,) rows sorted by name, for the lookup by name
+    search_*.npy              name search index and feature matrix (see search.py)
+    manifest.json             version, number of products, k and columns
+
+In S3 every version lives in its own folder and recommendations/bundle/manifest.json
+points to the one being served, so a new version is published by uploading its
+files first and the manifest last.
+
+Usage:
+    python bundle.py frame.pkl top_k_neighbors.pkl --version v1 --upload
+"""
+import os
+import json
+import bisect
+import shutil
+import argparse
+import numpy as np
+import search
+from common import artifacts
+
+S3_BUCKET: str = 'myawzbucket'
+S3_BUNDLE_PREFIX:str = 'recommendations/bundle'
+# Local folder for the bundles in the Lambda env (one folder per version)
+BUNDLE_PATH:str = '/tmp/bundle'
+
+MANIFEST_NAME:str = 'manifest.json'
+BUNDLE_FORMAT:int = 4
+
+# Columns returned for each recommended product, in the order of the response
+COLUMNS:tuple = ('manufacturer', 'name', 'ratings', 'no_of_ratings', 'discount_price', 'actual_price')
+STRING_COLUMNS:tuple = ('manufacturer', 'name')
+# Arrays of the name search index and of the feature matrix, besides their vocabularies
+SEARCH_ARRAYS:tuple = ('postings_ptr', 'postings', 'row_tokens', 'prefix_order', 'features_indptr', 'features_indices', 'features_data')
+# String tables of the search index: tokens of the inverted index and CountVectorizer vocabulary
+SEARCH_STRINGS:tuple = ('tokens', 'vocabulary')
+
+s3 = artifacts.s3
+
+class StringTable:
+    """
+    Column of strings stored as offsets + UTF-8 bytes, decoded only for the rows that are read.
+    """
+
+    def __init__(self, offsets, data, null=None):
+        self.offsets = offsets
+        self.data = data
+        self.null = null
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if self.null is not None and self.null[row]:
+            return None
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def take(self, rows)->list:
+        """
+        Decode several rows.
+        return: list of str
+        params: rows (iterable of int)
+        """
+        return [self[row] for row in rows]
+
+def encode_strings(values):
+    """
+    Build the string table of a column.
+    return: (offsets int64 (N + 1,), bytes uint8, null mask or None)
+    params: values (iterable of str, None/NaN for missing values)
+    """
+    null = np.array([not isinstance(value, str) for value in values], dtype=bool)
+    encoded = [value.encode('utf-8') if isinstance(value, str) else b'' for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data, (null if null.any() else None)
+
+def save_bundle(frame, top_k_neighbors, path, version, features=None, scores=None)->dict:
+    """
+    Write a bundle from the notebook artifacts.
+    return: manifest dict
+    params: frame (DataFrame with the COLUMNS, in the order used for top_k_neighbors), top_k_neighbors (N x k array), path (folder), version (str),
+            features (dict from search.build_features, fitted on frame if None), scores (N x k neighbor similarities, computed if None)
+    raise: ValueError if frame and top_k_neighbors do not match
+    """
+    neighbors = np.ascontiguousarray(top_k_neighbors, dtype=np.int32)
+    n = len(frame)
+    if neighbors.shape[0] != n or (n and neighbors.max() >= n):
+        raise ValueError(f'top_k_neighbors {neighbors.shape} does not match the {n} rows of frame')
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'neighbors.npy'), neighbors)
+    nullable = []
+    for column in COLUMNS:
+        values = frame[column].tolist()
+        if column in STRING_COLUMNS:
+            offsets, data, null = encode_strings(values)
+            np.save(os.path.join(path, f'{column}_offsets.npy'), offsets)
+            np.save(os.path.join(path, f'{column}_bytes.npy'), data)
+            if null is not None:
+                np.save(os.path.join(path, f'{column}_null.npy'), null)
+                nullable.append(column)
+        else:
+            np.save(os.path.join(path, f'{column}.npy'), np.asarray(values, dtype=np.float64))
+
+    # Orden estable: entre nombres repetidos gana el último, como en name_to_idx_map
+    names = np.array(frame['name'].tolist(), dtype=object)
+    np.save(os.path.join(path, 'name_order.npy'), np.argsort(names, kind='stable').astype(np.int32))
+
+    index = search.build_index(frame['name'].tolist())
+    index.update(features or search.build_features(frame['name'].tolist()))
+    if scores is None:
+        scores = search.neighbor_scores(search.feature_matrix(index, n), neighbors)
+    np.save(os.path.join(path, 'neighbor_scores.npy'), np.asarray(scores, dtype=np.float32))
+    for name in SEARCH_STRINGS:
+        offsets, data, _ = encode_strings(index[name])
+        np.save(os.path.join(path, f'search_{name}_offsets.npy'), offsets)
+        np.save(os.path.join(path, f'search_{name}_bytes.npy'), data)
+    for name in SEARCH_ARRAYS:
+        np.save(os.path.join(path, f'search_{name}.npy'), index[name])
+
+    manifest = {
+        'version': version,
+        'format': BUNDLE_FORMAT,
+        'n_products': n,
+        'k': int(neighbors.shape[1]),
+        'columns': list(COLUMNS),
+        'string_columns': list(STRING_COLUMNS),
+        'nullable': nullable,
+    }
+    # sha256 de cada archivo: la Lambda verifica lo que descarga
+    manifest['checksums'] = {file_name: artifacts.file_sha256(os.path.join(path, file_name))
+                             for file_name in bundle_files(manifest) if file_name != MANIFEST_NAME}
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+def bundle_files(manifest)->list:
+    """
+    Names of the files of a bundle.
+    return: list of str
+    params: manifest (dict)
+    """
+    files = ['neighbors.npy', 'neighbor_scores.npy', 'name_order.npy', MANIFEST_NAME]
+    files += [f'search_{name}.npy' for name in SEARCH_ARRAYS]
+    for name in SEARCH_STRINGS:
+        files += [f'search_{name}_offsets.npy', f'search_{name}_bytes.npy']
+    for column in manifest['columns']:
+        if column in manifest['string_columns']:
+            files += [f'{column}_offsets.npy', f'{column}_bytes.npy']
+            if column in manifest['nullable']:
+                files.append(f'{column}_null.npy')
+        else:
+            files.append(f'{column}.npy')
+    return files
+
+def load_bundle(path)->dict:
+    """
+    Memory-map a bundle and check that its arrays match the manifest.
+    return: dict with 'manifest', 'neighbors', 'neighbor_scores', 'name_order', 'columns' {column: np.memmap or StringTable} and 'search'
+    params: path (folder)
+    raise: ValueError if the bundle is not consistent
+    """
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != BUNDLE_FORMAT:
+        raise ValueError(f'Unsupported bundle format {manifest.get("format")}')
+
+    def load(name):
+        return np.load(os.path.join(path, name), mmap_mode='r')
+
+    columns = {}
+    for column in manifest['columns']:
+        if column in manifest['string_columns']:
+            null = load(f'{column}_null.npy') if column in manifest['nullable'] else None
+            columns[column] = StringTable(load(f'{column}_offsets.npy'), load(f'{column}_bytes.npy'), null)
+        else:
+            columns[column] = load(f'{column}.npy')
+    bundle = {
+        'manifest': manifest,
+        'neighbors': load('neighbors.npy'),
+        'neighbor_scores': load('neighbor_scores.npy'),
+        'name_order': load('name_order.npy'),
+        'columns': columns,
+        'search': {name: load(f'search_{name}.npy') for name in SEARCH_ARRAYS},
+    }
+    for name in SEARCH_STRINGS:
+        bundle['search'][name] = StringTable(load(f'search_{name}_offsets.npy'), load(f'search_{name}_bytes.npy'))
+
+    n = manifest['n_products']
+    index = bundle['search']
+    if bundle['neighbors'].shape != (n, manifest['k']) or bundle['neighbor_scores'].shape != (n, manifest['k']) or len(bundle['name_order']) != n:
+        raise ValueError(f'Bundle {manifest["version"]} arrays do not match its {n} products')
+    if len(index['row_tokens']) != n or len(index['prefix_order']) != n or index['postings_ptr'][-1] != len(index['postings']) \
+            or len(index['features_indptr']) != len(index['vocabulary']) + 1 or index['features_indptr'][-1] != len(index['features_indices']):
+        raise ValueError(f'Bundle {manifest["version"]} arrays do not match its {n} products')
+    for column, values in columns.items():
+        if len(values) != n:
+            raise ValueError(f'Bundle {manifest["version"]} column {column} has {len(values)} rows, expected {n}')
+    return bundle
+
+def find_index(bundle, product_name)->int:
+    """
+    Row of a product name, by binary search over name_order.
+    return: int, -1 if the name is not in the bundle
+    params: bundle (dict from load_bundle), product_name (str)
+    """
+    names = bundle['columns']['name']
+    order = bundle['name_order']
+    position = bisect.bisect_right(order, product_name, key=lambda row: names[row])
+    if position and names[order[position - 1]] == product_name:
+        return int(order[position - 1])
+    return -1
+
+def read_manifest_s3():
+    """
+    Read the manifest of the bundle being served.
+    return: (manifest dict, ETag)
+    params: None
+    """
+    response = s3.get_object(Bucket=S3_BUCKET, Key=f'{S3_BUNDLE_PREFIX}/{MANIFEST_NAME}')
+    return json.loads(response['Body'].read()), response['ETag']
+
+def download_bundle(manifest, path=BUNDLE_PATH)->str:
+    """
+    Download the files of a bundle version that are not already on disk, all at once and verified.
+    return: local folder of the version
+    params: manifest (dict), path (local root folder)
+    raise: Exception if a file is missing in S3 or does not match its checksum
+    """
+    version = manifest['version']
+    local_dir = os.path.join(path, version)
+    checksums = manifest.get('checksums', {})
+    artifacts.ensure([artifacts.Artifact(f'{S3_BUNDLE_PREFIX}/{version}/{file_name}', os.path.join(local_dir, file_name),
+                                         S3_BUCKET, sha256=checksums.get(file_name))
+                      for file_name in bundle_files(manifest)])
+    return local_dir
+
+def remove_old_versions(version, path=BUNDLE_PATH)->list:
+    """
+    Delete the local folders of every bundle version but the one being served, so updates don't fill /tmp.
+    return: list of removed versions
+    params: version (str, version to keep), path (local root folder)
+    """
+    if not os.path.isdir(path):
+        return []
+    removed = []
+    for entry in os.scandir(path):
+        if entry.is_dir() and entry.name != version:
+            # Los memmaps del bundle anterior siguen siendo válidos: Linux libera el archivo al cerrarlos
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.name)
+    return removed
+
+def upload_bundle(path)->None:
+    """
+    Upload a local bundle to its version folder and then point the served manifest to it.
+    return: None
+    params: path (local folder)
+    """
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    version = manifest['version']
+    for file_name in bundle_files(manifest):
+        artifacts.upload_file(os.path.join(path, file_name), f'{S3_BUNDLE_PREFIX}/{version}/{file_name}', S3_BUCKET)
+    s3.upload_file(os.path.join(path, MANIFEST_NAME), S3_BUCKET, f'{S3_BUNDLE_PREFIX}/{MANIFEST_NAME}')
+    print(f'Bundle {version} uploaded to {S3_BUCKET}/{S3_BUNDLE_PREFIX}/{version}')
+
+if __name__ == "__main__":
+    import pickle
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description='Convert the notebook pickles into a bundle.')
+    parser.add_argument('frame', help='Pickled frame of Explo.ipynb')
+    parser.add_argument('top_k_neighbors', help='Pickled top_k_neighbors array')
+    parser.add_argument('--version', required=True)
+    parser.add_argument('--out', default=None, help='Output folder (default: ./bundle/<version>)')
+    parser.add_argument('--upload', action='store_true', help='Upload the bundle to S3 when done')
+    args = parser.parse_args()
+
+    frame = pd.read_pickle(args.frame).reset_index(drop=True)
+    with open(args.top_k_neighbors, 'rb') as f:
+        top_k_neighbors = pickle.load(f)
+    out = args.out or os.path.join('bundle', args.version)
+    manifest = save_bundle(frame, top_k_neighbors, out, args.version)
+    print(f'Bundle {args.version}: {manifest["n_products"]} products, k={manifest["k"]}, saved in {out}')
+    if args.upload:
+        upload_bundle(out)
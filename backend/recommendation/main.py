@@ -1,109 +1,235 @@
-import pandas as pd
-import pickle
+import numpy as np
 import json
-import boto3
 import os
+import time
+import bundle
+import search
 
-#global top_k_neighbors
-#global name_to_idx_map
-#global frame 
 global status_error
 
-S3_BUCKET: str = 'myawzbucket'
+# Seconds between checks of the S3 ETag of the bundle manifest on a warm container
+ETAG_CHECK_SECONDS:int = int(os.environ.get('ETAG_CHECK_SECONDS', '60'))
+# Max number of product names in one request
+MAX_BATCH_SIZE:int = 100
+# Recommendations per product when the request does not give 'k'
+DEFAULT_K:int = 10
+# How names are matched: 'exact', or 'closest' to fall back to the name search index
+MATCH_MODES:tuple = ('exact', 'closest')
+# Max number of names returned by autocomplete
+MAX_AUTOCOMPLETE:int = 50
+# Max number of products returned for a free-text query
+MAX_QUERY_K:int = 50
 
-# TOP_NEIGHBORS
-TOP_NEIGHBORS_PATH:str = '/tmp/top_k_neighbors.pkl'
-# NAME_TO_IDX_MAP
-NAME_TO_IDX_MAP_PATH:str = '/tmp/name_to_idx_map.pkl'
-# FRAME
-FRAME_PATH:str = '/tmp/frame.pkl'
+# Shared pooled S3 client of common/artifacts.py
+s3 = bundle.s3
 
-# S3 paths 
-TOP_NEIGHBORS_PATH_S3:str = 'recommendations/top_k_neighbors.pkl'
-NAME_TO_IDX_MAP_PATH_S3:str = 'recommendations/name_to_idx_map.pkl'
-FRAME_PATH_S3:str = 'recommendations/frame.pkl'
-
-s3 = boto3.client('s3')
+# Bundle kept in memory across warm invocations, with the ETag of the manifest it was loaded from
+artifacts:dict = {
+    'bundle': None,
+    'etag': None,
+    'checked_at': 0.0,
+    'loads': 0,
+}
 
 def is_valid_data(input_data):
     """
     Validate the input data.
-    return: True if the input is valid, else a JSON response with an error message
-    params: input_data (list of numbers)
-    raise: Exception if the input data is invalid
+    return: True if the input is valid, else False and status_error holds the error response
+    params: input_data (product name, or list of product names)
     """
+    global status_error
 
-    # Check if the input data is a list
-    if not input_data or not isinstance(input_data, str):
+    names = input_data if isinstance(input_data, list) else [input_data]
+    # Check if the input data is empty
+    if not input_data:
         status_error = {
             'statusCode': 400,
-            'body': json.dumps({'ERROR': 'Invalid input. Provide an integer for the input data.'})
+            'body': json.dumps({'ERROR': 'Invalid input. No input data'})
         }
         return False
-    # Check if the input data is empty
-    if not input_data:
+    # Check if every product name is a non-empty string
+    if not all(name and isinstance(name, str) for name in names):
         status_error = {
             'statusCode': 400,
-            'body': json.dumps({'ERROR': 'Invalid input. No input data'})
+            'body': json.dumps({'ERROR': 'Invalid input. Provide a product name or a list of product names.'})
+        }
+        return False
+    if len(names) > MAX_BATCH_SIZE:
+        status_error = {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. At most {MAX_BATCH_SIZE} product names per request.'})
+        }
+        return False
+    status_error = None
+    return True
+
+def is_valid_k(k, max_k):
+    """
+    Validate the number of recommendations per product.
+    return: True if k is valid, else False and status_error holds the error response
+    params: k (int), max_k (int, neighbors stored per product)
+    """
+    global status_error
+
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= max_k:
+        status_error = {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. k must be an integer between 1 and {max_k}.'})
         }
         return False
-    else:
-        status_error = None
-        return True
+    status_error = None
+    return True
 
-def load_files_from_s3(lambda_path,s3_path)->None:
+def get_artifacts():
     """
-    Load the model from S3 if it's not already loaded.
-    return: model
+    Get the bundle, loading it only on the first call or when the S3 manifest changes.
+    return: dict from bundle.load_bundle
     params: None
-    raise: Exception if the model file does not exist in S3
-    """
-    
-    # Check if the files exists
-    if not os.path.exists(lambda_path):
-        print("Downloading from S3...")
-        print(f'{S3_BUCKET} --- {s3_path} --- {lambda_path}')
-        s3.download_file(S3_BUCKET, s3_path, lambda_path)
-        print("Files downloaded.")
-    
-    print("All Loaded in the lambda")
-
-def import_files():
-    """
-    import the pickle files
-    """
-
-    with open('/tmp/top_k_neighbors.pkl', 'rb') as f:
-        top_k_neighbors = pickle.load(f)
-    with open('/tmp/name_to_idx_map.pkl', 'rb') as f:
-        name_to_idx_map = pickle.load(f)
-    with open('/tmp/frame.pkl', 'rb') as f:
-        frame = pickle.load(f)
-    return top_k_neighbors, name_to_idx_map, frame
-
-def find_index_by_name(product_name,name_to_idx_map):
-
-    return name_to_idx_map.get(product_name, -1)
-
-def get_similar_products(product_query, name_to_idx_map,top_k_neighbors,frame, k=10):
-    """
-    1) Check the product_query 
-    2) Retrieve the product index.
-    3) Extract top-k neighbors.
-    4) Return recommended items as a DataFrame.
-    """
-    idx = find_index_by_name(product_query,name_to_idx_map)
-    
-    if idx == -1:
-        print(f"Product '{product_query}' not found in the dataset.")
-        return pd.DataFrame()
-    
-    neighbors_indices = top_k_neighbors[idx][:k]
-    
-    rec_df = frame.iloc[neighbors_indices].copy()
-    rec_df = rec_df[['manufacturer','name','ratings','no_of_ratings','discount_price','actual_price']]
-    rec_df.reset_index(drop=True, inplace=True)
-    return rec_df
+    raise: Exception if the bundle can't be downloaded or is not consistent
+    """
+    loaded = artifacts['bundle'] is not None
+    # Contenedor caliente: no se consulta S3 en cada invocación
+    if loaded and time.time() - artifacts['checked_at'] < ETAG_CHECK_SECONDS:
+        return artifacts['bundle']
+
+    etag = s3.head_object(Bucket=bundle.S3_BUCKET, Key=f'{bundle.S3_BUNDLE_PREFIX}/{bundle.MANIFEST_NAME}')['ETag']
+    artifacts['checked_at'] = time.time()
+    if loaded and etag == artifacts['etag']:
+        return artifacts['bundle']
+
+    try:
+        manifest, etag = bundle.read_manifest_s3()
+        print(f"Loading bundle {manifest['version']}...")
+        local_dir = bundle.download_bundle(manifest)
+        new_bundle = bundle.load_bundle(local_dir)
+    except Exception as e:
+        # Si ya hay un bundle válido en memoria, se sigue usando
+        if not loaded:
+            raise
+        print(f"New bundle rejected, keeping {artifacts['bundle']['manifest']['version']}: {e}")
+        return artifacts['bundle']
+    artifacts['loads'] += 1
+
+    artifacts.update({'bundle': new_bundle, 'etag': etag})
+    # Las versiones anteriores ya no se sirven: liberar /tmp
+    removed = bundle.remove_old_versions(manifest['version'])
+    if removed:
+        print(f"Removed old bundle versions: {removed}")
+    return new_bundle
+
+def find_product(products, product_query, match='exact')->int:
+    """
+    Row of a product name, falling back to the closest name when match is 'closest'.
+    return: int, -1 if the product is not found
+    params: products (dict from bundle.load_bundle), product_query (str), match (str in MATCH_MODES)
+    """
+    idx = bundle.find_index(products, product_query)
+    if idx == -1 and match == 'closest':
+        idx = search.closest(products['search'], product_query)
+    return idx
+
+def autocomplete(products, text, limit=10)->list:
+    """
+    Product names that start with a text (case insensitive).
+    return: list of str
+    params: products (dict from bundle.load_bundle), text (str), limit (int)
+    """
+    names = products['columns']['name']
+    return names.take(search.prefix(products['search'], names, text, limit))
+
+def product_records(products, rows)->list:
+    """
+    Response columns of several products, gathered with one indexing operation per column.
+    return: list of dicts
+    params: products (dict from bundle.load_bundle), rows (np.array of int)
+    """
+    columns = products['columns']
+    values = []
+    for column in bundle.COLUMNS:
+        if column in bundle.STRING_COLUMNS:
+            values.append(columns[column].take(rows))
+        else:
+            values.append(columns[column][rows].tolist())
+    return [dict(zip(bundle.COLUMNS, row)) for row in zip(*values)]
+
+def get_similar_products_batch(product_queries, products, k=10, match='exact'):
+    """
+    Top-k recommendations of several products, gathered with one indexing operation per column.
+    return: list with the list of recommended items (dicts) of each query, empty if the product is not found
+    params: product_queries (list of str), products (dict from bundle.load_bundle), k (int), match (str in MATCH_MODES)
+    """
+    indices = np.array([find_product(products, query, match) for query in product_queries], dtype=np.int64)
+    found = np.flatnonzero(indices >= 0)
+    for position in np.flatnonzero(indices < 0):
+        print(f"Product '{product_queries[position]}' not found in the dataset.")
+
+    # Filas de vecinos de todos los productos encontrados, en un solo gather
+    neighbors_indices = np.asarray(products['neighbors'][indices[found], :k]).ravel()
+    records = product_records(products, neighbors_indices)
+
+    results = [[] for _ in product_queries]
+    for rank, position in enumerate(found):
+        results[position] = records[rank * k:(rank + 1) * k]
+    return results
+
+def get_similar_products(product_query, products, k=10, match='exact'):
+    """
+    Top-k recommendations of one product.
+    return: list of recommended items (dicts), empty if the product is not found
+    params: product_query (str), products (dict from bundle.load_bundle), k (int), match (str in MATCH_MODES)
+    """
+    return get_similar_products_batch([product_query], products, k, match)[0]
+
+def search_products(products, text, k=10)->list:
+    """
+    Products most similar to a free text, for titles that are not in the catalog.
+    return: list of recommended items (dicts)
+    params: products (dict from bundle.load_bundle), text (str), k (int)
+    """
+    rows, _ = search.similar(products['search'], text, k)
+    return product_records(products, rows)
+
+def handle_query(text, k):
+    """
+    Answer a free-text similarity request.
+    return: JSON response with the most similar products
+    params: text (str), k (int)
+    """
+    if not text or not isinstance(text, str):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': 'Invalid input. Provide a query text.'})
+        }
+    if not is_valid_k(k, MAX_QUERY_K):
+        return status_error
+    products = get_artifacts()
+    start_time = time.perf_counter()
+    recommended_product_list = search_products(products, text, k)
+    print(json.dumps({'query_ms': round((time.perf_counter() - start_time) * 1000, 3), 'products': len(recommended_product_list)}))
+    return {
+        'statusCode': 200,
+        'body': json.dumps(recommended_product_list)
+    }
+
+def handle_autocomplete(text, limit):
+    """
+    Answer an autocomplete request.
+    return: JSON response with the matching product names
+    params: text (str), limit (int)
+    """
+    if not text or not isinstance(text, str) or isinstance(limit, bool) or not isinstance(limit, int) or not 1 <= limit <= MAX_AUTOCOMPLETE:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. Provide a prefix and a limit between 1 and {MAX_AUTOCOMPLETE}.'})
+        }
+    products = get_artifacts()
+    start_time = time.perf_counter()
+    names = autocomplete(products, text, limit)
+    print(json.dumps({'autocomplete_ms': round((time.perf_counter() - start_time) * 1000, 3), 'names': len(names)}))
+    return {
+        'statusCode': 200,
+        'body': json.dumps(names)
+    }
 
 def lambda_handler(event, context):
     global status_error
@@ -123,32 +249,52 @@ def lambda_handler(event, context):
             print(f'Input Data: {str(input_data)}')
             print(f'Type: {type_data}')
         
+            # Autocomplete: {"prefix": "...", "limit": n}
+            if "prefix" in parsed_body:
+                return handle_autocomplete(parsed_body.get("prefix"), parsed_body.get("limit", 10))
+
+            # Free-text similarity: {"query": "...", "k": n}
+            if "query" in parsed_body:
+                return handle_query(parsed_body.get("query"), parsed_body.get("k", DEFAULT_K))
+
             # Validate input
             if is_valid_data(input_data):
                 print('Valid Input')
 
-                # Download the files from S3
-                print("Downloading from S3...")
-                load_files_from_s3(TOP_NEIGHBORS_PATH, TOP_NEIGHBORS_PATH_S3)
-                load_files_from_s3(NAME_TO_IDX_MAP_PATH, NAME_TO_IDX_MAP_PATH_S3)
-                load_files_from_s3(FRAME_PATH, FRAME_PATH_S3)
-  
-
-                # Get the ready to use data
-                top_k_neighbors, name_to_idx_map, frame = import_files()
+                # Get the ready to use data (loaded once per container)
+                start_time = time.perf_counter()
+                loads_before = artifacts['loads']
+                products = get_artifacts()
+                artifacts_ms = (time.perf_counter() - start_time) * 1000
                 print("Variables ready")
 
-                # Put the number of the product here
-                product = input_data
-                #product = frame['name'].iloc[selected_product]
-                print(f'Product: {product}')
-
-                # Get recommended products
-                recommended_product = get_similar_products(product, name_to_idx_map,top_k_neighbors, frame, k=10)
+                k = parsed_body.get("k", DEFAULT_K)
+                if not is_valid_k(k, products['manifest']['k']):
+                    return status_error
+                match = parsed_body.get("match", "exact")
+                if match not in MATCH_MODES:
+                    return {
+                        'statusCode': 400,
+                        'body': json.dumps({'ERROR': f'Invalid input. match must be one of {list(MATCH_MODES)}.'})
+                    }
 
-                # Convert the DataFrame to a list of dictionaries
-                recommended_product_list = recommended_product.to_dict(orient='records')
-                print(f'Recommended Product: {recommended_product_list}')
+                # Get recommended products: one list per name for a batch, a flat list for one name
+                start_time = time.perf_counter()
+                if isinstance(input_data, list):
+                    recommended_product_list = get_similar_products_batch(input_data, products, k=k, match=match)
+                else:
+                    print(f'Product: {input_data}')
+                    recommended_product_list = get_similar_products(input_data, products, k=k, match=match)
+                lookup_ms = (time.perf_counter() - start_time) * 1000
+                if not isinstance(input_data, list):
+                    print(f'Recommended Product: {recommended_product_list}')
+                # Timing of the request: on a warm container 'deserialized' is 0
+                print(json.dumps({
+                    'artifacts_ms': round(artifacts_ms, 3),
+                    'lookup_ms': round(lookup_ms, 3),
+                    'products': len(input_data) if isinstance(input_data, list) else 1,
+                    'deserialized': artifacts['loads'] - loads_before,
+                }))
 
                 return {
                     'statusCode': 200,
@@ -0,0 +1,195 @@
+"""
+Search over the product names of the recommendation bundle.
+
+Names are normalized like the search_terms of Explo.ipynb (lowercase,
+punctuation to spaces, Porter stemming of every token) and indexed offline:
+
+    tokens          sorted vocabulary of normalized tokens
+    postings_ptr    int64 (T + 1,) postings of token t are postings[ptr[t]:ptr[t + 1]]
+    postings        int32 rows whose name contains each token
+    row_tokens      int32 (N,) number of distinct tokens of each name
+    prefix_order    int32 (N,) rows sorted by lowercased name, for autocomplete
+
+closest() answers "which product did the user mean" and prefix() answers
+autocomplete, both without comparing the query with every name.
+
+For free-text queries the bundle also keeps the CountVectorizer of the
+notebook as its sorted vocabulary and the L2-normalized feature matrix in CSC
+form (features_indptr, features_indices, features_data), so similar() scores a
+query against every product by reading only the columns of its terms.
+"""
+import re
+import bisect
+import numpy as np
+from nltk.stem.porter import PorterStemmer
+
+stemmer = PorterStemmer()
+
+def normalize(text)->list:
+    """
+    Tokens of a text with the normalization of the notebook.
+    return: list of str
+    params: text (str)
+    """
+    text = re.sub(r'[^\w\d\s]+', ' ', text.lower())
+    return [stemmer.stem(word) for word in text.split()]
+
+def build_index(names)->dict:
+    """
+    Build the inverted index and the prefix order of the product names.
+    return: dict {'tokens': sorted list of str, 'postings_ptr', 'postings', 'row_tokens', 'prefix_order'}
+    params: names (list of str, one per row)
+    """
+    row_tokens = [sorted(set(normalize(name))) for name in names]
+    tokens = sorted({token for row in row_tokens for token in row})
+    token_ids = {token: i for i, token in enumerate(tokens)}
+
+    postings = [[] for _ in tokens]
+    for row, row_token_list in enumerate(row_tokens):
+        for token in row_token_list:
+            postings[token_ids[token]].append(row)
+    postings_ptr = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in postings], out=postings_ptr[1:])
+
+    lowered = np.array([name.lower() for name in names], dtype=object)
+    return {
+        'tokens': tokens,
+        'postings_ptr': postings_ptr,
+        'postings': np.array([row for rows in postings for row in rows], dtype=np.int32),
+        'row_tokens': np.array([len(row) for row in row_tokens], dtype=np.int32),
+        'prefix_order': np.argsort(lowered, kind='stable').astype(np.int32),
+    }
+
+def build_features(names)->dict:
+    """
+    Fit the CountVectorizer of the notebook on the normalized names and L2-normalize its rows.
+    return: dict {'vocabulary': sorted list of str, 'features_indptr', 'features_indices', 'features_data'}
+    params: names (list of str, one per row)
+    """
+    # Solo hace falta para construir el bundle, no en la Lambda
+    from sklearn.feature_extraction.text import CountVectorizer
+    from sklearn.preprocessing import normalize as l2_normalize
+
+    vectorizer = CountVectorizer(
+        max_features=5000,
+        stop_words='english',
+        dtype=np.int8
+    )
+    feature_matrix = vectorizer.fit_transform([' '.join(normalize(name)) for name in names])
+    features = l2_normalize(feature_matrix.astype(np.float32), norm='l2').tocsc()
+    features.sort_indices()
+    return {
+        'vocabulary': list(vectorizer.get_feature_names_out()),
+        'features_indptr': features.indptr.astype(np.int64),
+        'features_indices': features.indices.astype(np.int32),
+        'features_data': features.data.astype(np.float32),
+    }
+
+def feature_matrix(index, n_rows):
+    """
+    Feature matrix of a bundle or of build_features as a scipy sparse matrix (only used offline).
+    return: scipy.sparse.csc_matrix (n_rows, V) float32
+    params: index (dict with the features_* arrays), n_rows (int)
+    """
+    from scipy.sparse import csc_matrix
+
+    shape = (n_rows, len(index['features_indptr']) - 1)
+    return csc_matrix((index['features_data'], index['features_indices'], index['features_indptr']), shape=shape)
+
+def neighbor_scores(features, neighbors):
+    """
+    Cosine similarity of every product with each of its neighbors.
+    return: np.array (N, k) float32
+    params: features (L2-normalized sparse matrix (N, V)), neighbors (N x k array)
+    """
+    features = features.tocsr()
+    scores = np.empty(neighbors.shape, dtype=np.float32)
+    for j in range(neighbors.shape[1]):
+        scores[:, j] = np.asarray(features.multiply(features[neighbors[:, j]]).sum(axis=1)).ravel()
+    return scores
+
+def token_id(index, token, tokens_key='tokens')->int:
+    """
+    Position of a token in a sorted vocabulary.
+    return: int, -1 if the token is not indexed
+    params: index (dict from build_index or bundle.load_bundle), token (str), tokens_key ('tokens' or 'vocabulary')
+    """
+    tokens = index[tokens_key]
+    position = bisect.bisect_left(tokens, token)
+    if position < len(tokens) and tokens[position] == token:
+        return position
+    return -1
+
+def closest(index, query)->int:
+    """
+    Row of the product name closest to a query: the highest sum of IDF of the
+    shared tokens, then the name with the fewest extra tokens, then the lowest row.
+    return: int, -1 if no token of the query is indexed
+    params: index (dict from build_index or bundle.load_bundle), query (str)
+    """
+    ids = [token_id(index, token) for token in set(normalize(query))]
+    ids = [i for i in ids if i >= 0]
+    if not ids:
+        return -1
+
+    ptr = index['postings_ptr']
+    n_rows = len(index['row_tokens'])
+    rows = np.concatenate([index['postings'][ptr[i]:ptr[i + 1]] for i in ids])
+    doc_freq = np.array([ptr[i + 1] - ptr[i] for i in ids])
+    weights = np.repeat(np.log((n_rows + 1) / doc_freq), doc_freq)
+
+    # Un bincount sobre N filas es más rápido que ordenar postings largos
+    scores = np.bincount(rows, weights=weights, minlength=n_rows)
+    candidates = np.flatnonzero(scores >= scores.max() - 1e-9)
+    best = np.lexsort((candidates, index['row_tokens'][candidates]))[0]
+    return int(candidates[best])
+
+def prefix(index, names, text, limit=10)->list:
+    """
+    Rows whose lowercased name starts with a text, in alphabetical order.
+    return: list of int
+    params: index (dict from build_index or bundle.load_bundle), names (name of each row), text (str), limit (int)
+    """
+    text = text.lower()
+    order = index['prefix_order']
+    position = bisect.bisect_left(order, text, key=lambda row: names[row].lower())
+    rows = []
+    while position < len(order) and len(rows) < limit:
+        row = int(order[position])
+        if not names[row].lower().startswith(text):
+            break
+        rows.append(row)
+        position += 1
+    return rows
+
+def similar(index, text, k=10):
+    """
+    Top-k products by cosine similarity between a free text and the feature matrix.
+    return: (rows int64, scores float32), by descending score and then by row; only rows with a positive score
+    params: index (dict from bundle.load_bundle), text (str), k (int)
+    """
+    # Mismo token_pattern que CountVectorizer sobre el texto normalizado
+    terms = re.findall(r'(?u)\b\w\w+\b', ' '.join(normalize(text)))
+    ids, counts = np.unique([token_id(index, term, 'vocabulary') for term in terms], return_counts=True)
+    counts = counts[ids >= 0].astype(np.float32)
+    ids = ids[ids >= 0]
+    if not len(ids):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    query = counts / np.linalg.norm(counts)
+
+    ptr = index['features_indptr']
+    n_rows = len(index['row_tokens'])
+    rows = np.concatenate([index['features_indices'][ptr[i]:ptr[i + 1]] for i in ids])
+    weights = np.concatenate([index['features_data'][ptr[i]:ptr[i + 1]] * value for i, value in zip(ids, query)])
+    scores = np.bincount(rows, weights=weights, minlength=n_rows).astype(np.float32)
+
+    positive = np.count_nonzero(scores > 0)
+    k = min(k, positive)
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    # Umbral del puesto k en O(N); entre empates en ese puesto entran las filas de menor índice
+    kth = -np.partition(-scores, k - 1)[k - 1]
+    above = np.flatnonzero(scores > kth)
+    top = np.concatenate([above, np.flatnonzero(scores == kth)[:k - len(above)]])
+    top = top[np.lexsort((top, -scores[top]))]
+    return top, scores[top]
@@ -0,0 +1,193 @@
+"""
+Incremental catalog update of a recommendation bundle.
+
+Instead of re-running the notebook (fit, N x N cosine_similarity and
+build_top_neighbors_matrix), a delta of added and removed products is applied
+to an existing bundle and written as a new version:
+
+- added products are vectorized with the vocabulary of the bundle (terms that
+  are not in it are ignored until the next full rebuild) and compared with the
+  catalog, delta x N;
+- the top-k of every existing product is merged with its best added products,
+  using the stored neighbor_scores;
+- only the products that had a removed product among their neighbors are
+  compared again with the whole catalog.
+
+Ties are broken by the lowest row, like models/recommendation/top_neighbors.py.
+
+Usage:
+    python update_bundle.py bundle/v1 --version v2 --add new_products.csv --remove removed.txt --upload
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize as l2_normalize
+import bundle
+import search
+
+# Rows compared with the whole catalog at a time (block_size x N dense similarities)
+BLOCK_SIZE:int = 256
+
+def top_k_dense(sims, k):
+    """
+    Top-k columns of each row of a dense similarity block.
+    return: (indices (B, k) int64, scores (B, k) float32), sorted by score and then by index
+    params: sims (np.array (B, M)), k (int, at most M)
+    """
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    # Empates en el k-ésimo lugar: quedarse con los de menor índice
+    kth = np.take_along_axis(sims, top, axis=1).min(axis=1)
+    for row in np.flatnonzero((sims >= kth[:, None]).sum(axis=1) > k):
+        above = np.flatnonzero(sims[row] > kth[row])
+        equal = np.flatnonzero(sims[row] == kth[row])[:k - len(above)]
+        top[row] = np.concatenate((above, equal))
+    return merge_top_k(top, np.take_along_axis(sims, top, axis=1), k)
+
+def merge_top_k(indices, scores, k):
+    """
+    Keep the k best candidates of each row.
+    return: (indices (B, k) int64, scores (B, k) float32), sorted by score and then by index
+    params: indices (B, C) candidate columns, scores (B, C), k (int)
+    """
+    order = np.lexsort((indices, -scores), axis=1)[:, :k]
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1).astype(np.float32)
+
+def vectorize(names, vocabulary):
+    """
+    Feature vectors of new product names with the vocabulary of a bundle.
+    return: L2-normalized sparse CSR matrix (n, V) float32
+    params: names (list of str), vocabulary (sorted list of str)
+    """
+    vectorizer = CountVectorizer(vocabulary=vocabulary, dtype=np.int8)
+    feature_matrix = vectorizer.transform([' '.join(search.normalize(name)) for name in names])
+    if not len(names):
+        return feature_matrix.astype(np.float32).tocsr()
+    return l2_normalize(feature_matrix.astype(np.float32), norm='l2').tocsr()
+
+def removed_rows(products, names)->np.array:
+    """
+    Rows of every product with one of the given names (all duplicates).
+    return: np.array of int
+    params: products (dict from bundle.load_bundle), names (list of str)
+    """
+    rows = []
+    order = products['name_order']
+    for name in names:
+        row = bundle.find_index(products, name)
+        if row == -1:
+            print(f"Product '{name}' not found in the bundle, nothing to remove.")
+            continue
+        # find_index devuelve el último repetido; los anteriores están justo antes en name_order
+        position = int(np.flatnonzero(order == row)[0])
+        while position >= 0 and products['columns']['name'][order[position]] == name:
+            rows.append(int(order[position]))
+            position -= 1
+    return np.unique(np.array(rows, dtype=np.int64))
+
+def update_neighbors(products, added, removed, k):
+    """
+    Top-k neighbors and scores of the updated catalog: kept products in their order, then the added ones.
+    return: (kept rows, features (N', V) CSR, neighbors (N', k) int32, scores (N', k) float32, n_recomputed)
+    params: products (dict from bundle.load_bundle), added (CSR matrix of the added products), removed (rows to drop), k (int)
+    """
+    n_old = products['manifest']['n_products']
+    old_features = search.feature_matrix(products['search'], n_old).tocsr()
+    keep = np.setdiff1d(np.arange(n_old), removed)
+    new_row = np.full(n_old, -1, dtype=np.int64)
+    new_row[keep] = np.arange(len(keep))
+    features = vstack([old_features[keep], added]).tocsr()
+    n_keep, n_new = len(keep), features.shape[0]
+    k = min(k, n_new - 1)
+
+    # Vecinos actuales de los productos que se quedan, con los eliminados marcados
+    neighbors = new_row[np.asarray(products['neighbors'][keep, :k])]
+    scores = np.asarray(products['neighbor_scores'][keep, :k], dtype=np.float32)
+    affected = np.flatnonzero((neighbors < 0).any(axis=1))
+    scores = np.where(neighbors < 0, -np.inf, scores).astype(np.float32)
+    neighbors = np.where(neighbors < 0, n_new, neighbors)
+
+    added_neighbors = np.empty((n_new - n_keep, k), dtype=np.int64)
+    added_scores = np.empty((n_new - n_keep, k), dtype=np.float32)
+    for start in range(n_keep, n_new, BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, n_new)
+        sims = (features[start:stop] @ features.T).toarray()
+        rows = np.arange(stop - start)
+        sims[rows, rows + start] = -np.inf
+        # Vecinos de los productos nuevos contra todo el catálogo
+        added_neighbors[start - n_keep:stop - n_keep], added_scores[start - n_keep:stop - n_keep] = top_k_dense(sims, k)
+        # Mejores productos nuevos de cada producto existente, fusionados con sus vecinos actuales
+        block_k = min(k, stop - start)
+        candidates, candidate_scores = top_k_dense(np.ascontiguousarray(sims[:, :n_keep].T), block_k)
+        neighbors, scores = merge_top_k(
+            np.concatenate((neighbors, candidates + start), axis=1),
+            np.concatenate((scores, candidate_scores), axis=1),
+            k,
+        )
+
+    # Los que perdieron un vecino se recalculan contra todo el catálogo
+    for start in range(0, len(affected), BLOCK_SIZE):
+        rows = affected[start:start + BLOCK_SIZE]
+        sims = (features[rows] @ features.T).toarray()
+        sims[np.arange(len(rows)), rows] = -np.inf
+        neighbors[rows], scores[rows] = top_k_dense(sims, k)
+
+    neighbors = np.concatenate((neighbors, added_neighbors)).astype(np.int32)
+    scores = np.concatenate((scores, added_scores))
+    return keep, features, neighbors, scores, len(affected)
+
+def update_bundle(path, out, version, added_frame=None, removed_names=()):
+    """
+    Apply a delta of products to a bundle and write it as a new version.
+    return: manifest dict of the new version
+    params: path (folder of the current bundle), out (output folder), version (str),
+            added_frame (DataFrame with the bundle.COLUMNS, or None), removed_names (list of str)
+    """
+    products = bundle.load_bundle(path)
+    if added_frame is None:
+        added_frame = pd.DataFrame(columns=list(bundle.COLUMNS))
+    vocabulary = products['search']['vocabulary'].take(range(len(products['search']['vocabulary'])))
+    added = vectorize(added_frame['name'].tolist(), vocabulary)
+    removed = removed_rows(products, removed_names)
+
+    keep, features, neighbors, scores, n_recomputed = update_neighbors(products, added, removed, products['manifest']['k'])
+    print(f'{len(added_frame)} added, {len(removed)} removed, {n_recomputed} rows recomputed, {features.shape[0]} products')
+
+    frame = pd.DataFrame({column: products['columns'][column].take(keep) if column in bundle.STRING_COLUMNS
+                          else np.asarray(products['columns'][column])[keep] for column in bundle.COLUMNS})
+    frame = pd.concat([frame, added_frame[list(bundle.COLUMNS)]], ignore_index=True)
+    features = features.tocsc()
+    features.sort_indices()
+    feature_arrays = {
+        'vocabulary': vocabulary,
+        'features_indptr': features.indptr.astype(np.int64),
+        'features_indices': features.indices.astype(np.int32),
+        'features_data': features.data.astype(np.float32),
+    }
+    return bundle.save_bundle(frame, neighbors, out, version, features=feature_arrays, scores=scores)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Apply added and removed products to a bundle.')
+    parser.add_argument('bundle', help='Folder of the current bundle')
+    parser.add_argument('--version', required=True, help='Version of the new bundle')
+    parser.add_argument('--add', default=None, help='CSV or pickle with the new products (bundle.COLUMNS)')
+    parser.add_argument('--remove', default=None, help='Text file with one product name to remove per line')
+    parser.add_argument('--out', default=None, help='Output folder (default: ./bundle/<version>)')
+    parser.add_argument('--upload', action='store_true', help='Upload the new bundle to S3 when done')
+    args = parser.parse_args()
+
+    added_frame = None
+    if args.add:
+        added_frame = pd.read_pickle(args.add) if args.add.endswith('.pkl') else pd.read_csv(args.add)
+    removed_names = []
+    if args.remove:
+        with open(args.remove) as f:
+            removed_names = [line.rstrip('\n') for line in f if line.strip()]
+
+    out = args.out or os.path.join('bundle', args.version)
+    manifest = update_bundle(args.bundle, out, args.version, added_frame, removed_names)
+    print(f'Bundle {args.version}: {manifest["n_products"]} products saved in {out}')
+    if args.upload:
+        bundle.upload_bundle(out)
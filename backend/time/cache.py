@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+# Max number of forecasts kept in memory
+CACHE_SIZE:int = int(os.environ.get('FORECAST_CACHE_SIZE', '256'))
+# Disk tier in the Lambda env, survives warm invocations (empty to disable it)
+CACHE_PATH:str = os.environ.get('FORECAST_CACHE_PATH', '/tmp/forecast_cache')
+# Max number of forecasts kept on disk
+CACHE_DISK_SIZE:int = int(os.environ.get('FORECAST_CACHE_DISK_SIZE', '4096'))
+
+# In-process LRU: the most recently used entries are at the end
+memory_cache = OrderedDict()
+# Hit/miss counters of this container
+stats:dict = {'hits': 0, 'misses': 0}
+
+def content_hash(arrays)->str:
+    """
+    Hash the content of a dataset, used as its version in the cache keys.
+    return: hex digest
+    params: arrays (list of np.array)
+    """
+    digest = hashlib.sha256()
+    for values in arrays:
+        digest.update(str(values.dtype).encode())
+        digest.update(memoryview(values).cast('B'))
+    return digest.hexdigest()
+
+def make_key(store, dept, data_version, model_version, window_size, n_forecast)->str:
+    """
+    Cache key of a forecast.
+    return: hex digest
+    params: store (int), dept (int), data_version (str), model_version (str), window_size (int), n_forecast (int)
+    """
+    raw = f'{store}|{dept}|{data_version}|{model_version}|{window_size}|{n_forecast}'
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def disk_path(key)->str:
+    """
+    Path of an entry in the disk tier.
+    return: str
+    params: key (str)
+    """
+    return os.path.join(CACHE_PATH, f'{key}.json')
+
+def remember(key, value)->None:
+    """
+    Put an entry in the memory tier, evicting the least recently used ones.
+    return: None
+    params: key (str), value (JSON serializable)
+    """
+    memory_cache[key] = value
+    memory_cache.move_to_end(key)
+    while len(memory_cache) > CACHE_SIZE:
+        memory_cache.popitem(last=False)
+
+def lookup(key):
+    """
+    Look up a forecast, first in memory and then on disk, telling where it was found.
+    return: (cached value or None, tier: 'hit-memory', 'hit-tmp' or 'miss')
+    params: key (str)
+    """
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        stats['hits'] += 1
+        return memory_cache[key], 'hit-memory'
+    if CACHE_PATH and os.path.exists(disk_path(key)):
+        with open(disk_path(key)) as f:
+            value = json.load(f)
+        remember(key, value)
+        stats['hits'] += 1
+        return value, 'hit-tmp'
+    stats['misses'] += 1
+    return None, 'miss'
+
+def get(key):
+    """
+    Look up a forecast, first in memory and then on disk.
+    return: cached value, or None on a miss
+    params: key (str)
+    """
+    return lookup(key)[0]
+
+def put(key, value)->None:
+    """
+    Store a forecast in memory and on disk.
+    return: None
+    params: key (str), value (JSON serializable)
+    """
+    remember(key, value)
+    if CACHE_PATH:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        # Escritura atómica: otra invocación nunca lee un archivo a medio escribir
+        tmp_path = f'{disk_path(key)}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, disk_path(key))
+        evict_disk()
+
+def evict_disk()->None:
+    """
+    Remove the least recently written entries when the disk tier is over its size.
+    return: None
+    params: None
+    """
+    entries = [entry for entry in os.scandir(CACHE_PATH) if entry.name.endswith('.json')]
+    if len(entries) <= CACHE_DISK_SIZE:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:len(entries) - CACHE_DISK_SIZE]:
+        os.remove(entry.path)
+
+def headers(tiers)->dict:
+    """
+    Cache result of a request as HTTP response headers; the container counters only go to the logs.
+    return: dict with X-Cache ('hit-memory', 'hit-tmp', 'miss', or 'mixed' for a batch with different tiers)
+    params: tiers (list of tiers from lookup, one per series of the request)
+    """
+    print(json.dumps({'event': 'forecast_cache', **stats}))
+    tiers = set(tiers) or {'miss'}
+    return {'X-Cache': tiers.pop() if len(tiers) == 1 else 'mixed'}
@@ -0,0 +1,134 @@
+"""
+NumPy inference for the forecast LSTM, so the Lambda does not need TensorFlow.
+
+export_params turns a trained build_model network (LSTM + Dropout + Dense)
+and its fitted MinMaxScaler into plain arrays. NumpyLSTM and NumpyScaler
+then run the forward pass and the scaling with the same interface used by
+forecast_series: model(x, training=False) and scaler.transform/inverse_transform.
+"""
+import numpy as np
+
+# Arrays of an exported model
+PARAM_NAMES:tuple = ('lstm_kernel', 'lstm_recurrent_kernel', 'lstm_bias', 'dense_kernel', 'dense_bias', 'scaler_min', 'scaler_scale')
+
+def export_params(model, scaler)->dict:
+    """
+    Extract the weights of a trained model and the parameters of its scaler.
+    return: dict {name: float32 np.array}
+    params: model (keras model from build_model), scaler (fitted MinMaxScaler)
+    """
+    lstm_kernel, lstm_recurrent_kernel, lstm_bias, dense_kernel, dense_bias = model.get_weights()
+    params = {
+        'lstm_kernel': lstm_kernel,
+        'lstm_recurrent_kernel': lstm_recurrent_kernel,
+        'lstm_bias': lstm_bias,
+        'dense_kernel': dense_kernel,
+        'dense_bias': dense_bias,
+        'scaler_min': scaler.min_,
+        'scaler_scale': scaler.scale_,
+    }
+    return {name: np.asarray(values, dtype=np.float32) for name, values in params.items()}
+
+def save_params(params, path)->None:
+    """
+    Save an exported model as a .npz file.
+    return: None
+    params: params (dict from export_params), path (str)
+    """
+    np.savez(path, **params)
+
+def load_params(path)->dict:
+    """
+    Load an exported model from a .npz file.
+    return: dict {name: np.array}
+    params: path (str)
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in PARAM_NAMES}
+
+def stack_params(params_list)->dict:
+    """
+    Stack the params of several models, so one forward pass runs each series with its own weights.
+    return: dict {name: np.array with a leading n_series axis}
+    params: params_list (list of dicts from export_params)
+    """
+    return {name: np.stack([params[name] for params in params_list]) for name in PARAM_NAMES}
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+class NumpyLSTM:
+    """
+    Forward pass of LSTM(relu) -> Dropout -> Dense(1), with the call signature of a keras model.
+    With stacked params, row i of the input is run with the weights of model i.
+    """
+
+    def __init__(self, params):
+        self.kernel = params['lstm_kernel']
+        self.recurrent_kernel = params['lstm_recurrent_kernel']
+        self.bias = params['lstm_bias']
+        self.dense_kernel = params['dense_kernel']
+        self.dense_bias = params['dense_bias']
+        self.stacked = self.kernel.ndim == 3
+        self.units = self.recurrent_kernel.shape[-2]
+
+    def __call__(self, x, training=False):
+        """
+        Predict the next value of each window.
+        return: np.array (n, 1)
+        params: x (array (n, window_size, 1)), training (ignored, Dropout is the identity at inference)
+        """
+        x = np.asarray(x, dtype=np.float32)
+        n = x.shape[0]
+        # Proyección de la entrada de todos los pasos de una vez
+        if self.stacked:
+            x_proj = np.einsum('nti,nij->ntj', x, self.kernel) + self.bias[:, None, :]
+        else:
+            x_proj = x @ self.kernel + self.bias
+        h = np.zeros((n, self.units), dtype=np.float32)
+        c = np.zeros((n, self.units), dtype=np.float32)
+        u = self.units
+        for t in range(x.shape[1]):
+            if self.stacked:
+                z = x_proj[:, t] + np.einsum('ni,nij->nj', h, self.recurrent_kernel)
+            else:
+                z = x_proj[:, t] + h @ self.recurrent_kernel
+            # Compuertas en el orden de keras: input, forget, cell, output
+            i = sigmoid(z[:, :u])
+            f = sigmoid(z[:, u:2 * u])
+            c = f * c + i * np.maximum(z[:, 2 * u:3 * u], 0.0)
+            o = sigmoid(z[:, 3 * u:])
+            h = o * np.maximum(c, 0.0)
+        if self.stacked:
+            return np.einsum('ni,nij->nj', h, self.dense_kernel) + self.dense_bias
+        return h @ self.dense_kernel + self.dense_bias
+
+class NumpyScaler:
+    """
+    MinMaxScaler transform and inverse_transform from exported params.
+    With stacked params, row i is scaled with the params of series i.
+    """
+
+    def __init__(self, params):
+        self.min = params['scaler_min'].reshape(-1, 1)
+        self.scale = params['scaler_scale'].reshape(-1, 1)
+
+    def transform(self, values):
+        return values * self.scale + self.min
+
+    def inverse_transform(self, values):
+        return (values - self.min) / self.scale
+
+def check_parity(model, params, window_size=4, n_samples=256, atol=1e-4)->float:
+    """
+    Compare the NumPy forward pass with keras on random windows.
+    return: max absolute difference
+    params: model (keras model), params (dict from export_params), window_size (int), n_samples (int), atol (float)
+    raise: ValueError if the difference is above atol
+    """
+    x = np.random.default_rng(0).random((n_samples, window_size, 1), dtype=np.float32)
+    expected = np.asarray(model(x, training=False))
+    diff = float(np.max(np.abs(NumpyLSTM(params)(x) - expected)))
+    if diff > atol:
+        raise ValueError(f'NumPy forward pass differs from keras by {diff}')
+    return diff
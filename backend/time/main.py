@@ -1,18 +1,20 @@
 import os
 import pandas as pd
 import numpy as np
-import boto3
 import json
-from sklearn.preprocessing import MinMaxScaler
-import tensorflow as tf
-from tensorflow.keras.models import Sequential # type: ignore
-from tensorflow.keras.layers import LSTM, Dense, Dropout # type: ignore
-
-train_df = None
-test_df = None
+from collections import OrderedDict
+import registry
+import lstm_numpy
+import snapshot
+import cache
+from botocore.exceptions import ClientError
+from common import artifacts
+
+train_index = None
+test_index = None
 status_error = None
 
-s3 = boto3.client('s3')
+s3 = artifacts.s3
 
 # Temporary paths to store files in the Lambda env
 DATA_PATH_TRAIN:str = '/tmp/cleaned_data.csv'
@@ -28,45 +30,115 @@ SHOPS:list = [x for x in range(1, 4)]
 
 
 INPUT_LEN:int = 2 # LEN of data input
+MAX_BATCH_SIZE:int = 100 # Max number of series in a batch request
+
+# Max number of models kept in memory (at least one batch)
+MODEL_CACHE_SIZE:int = max(int(os.environ.get('MODEL_CACHE_SIZE', '256')), MAX_BATCH_SIZE)
+# Params of the models already loaded (or trained on demand) in this container, by (store, dept).
+# LRU like cache.py: the most recently used models are at the end
+loaded_models = OrderedDict()
+
+def load_dataset(file_name, csv_path):
+    """
+    Load a dataset as a series index, from its binary snapshot if there is one, else from the CSV.
+    return: dict from build_series_index
+    params: file_name (str, S3 key of the CSV), csv_path (str, local path of the CSV)
+    raise: Exception if neither the snapshot nor the CSV exist in S3
+    """
+    name = snapshot.snapshot_name(file_name)
+    snapshot_path = os.path.join(snapshot.SNAPSHOT_PATH, name)
+    if snapshot.download_snapshot(name, snapshot_path):
+        # Memory-map: sin parsear el CSV, solo se leen las páginas que se usan
+        print(f"Loading {name} snapshot...")
+        return index_from_arrays(snapshot.load_snapshot(snapshot_path))
+
+    # Sin snapshot: descargar y leer el CSV
+    artifacts.ensure([artifacts.Artifact(file_name, csv_path, S3_BUCKET)])
+    print(f"Loading {file_name}...")
+    return build_series_index(pd.read_csv(csv_path))
+
+def prefetch_artifacts()->None:
+    """
+    Download the snapshots of the datasets and the registry manifest at once.
+    return: None
+    params: None
+    """
+    declared = [registry.manifest_artifact()]
+    for file_name in sorted({TRAIN_FILE_NAME, TEST_FILE_NAME}):
+        name = snapshot.snapshot_name(file_name)
+        declared += snapshot.snapshot_artifacts(name, os.path.join(snapshot.SNAPSHOT_PATH, name))
+    try:
+        artifacts.ensure(declared)
+    except ClientError as e:
+        # Lo que falte se resuelve archivo a archivo (CSV si no hay snapshot)
+        print(f"Prefetch incomplete: {e}")
 
 def load_files_from_s3()->None:
     """
-    Load the model from S3 if it's not already loaded.
-    return: model
+    Load the datasets from S3 if they're not already loaded.
+    return: None
     params: None
-    raise: Exception if the model file does not exist in S3
+    raise: Exception if the dataset files do not exist in S3
     """
-    global train_df
-    global test_df
+    global train_index
+    global test_index
     
-    # If the model is already loaded, return it
-    if train_df is not None and not train_df.empty and test_df is not None and not test_df.empty:
+    # If the data is already loaded, return
+    if train_index is not None and test_index is not None:
         print("Dataset already loaded.")
         return None
 
-    # Check if the files exists
-    if not os.path.exists(DATA_PATH_TRAIN):
-        print("Downloading TRAIN dataset from S3...")
-        s3.download_file(S3_BUCKET, TRAIN_FILE_NAME, DATA_PATH_TRAIN)
-        print("Train dataset downloaded.")
-    if not os.path.exists(DATA_PATH_TEST):
-        print("Downloading TEST dataset from S3...")
-        s3.download_file(S3_BUCKET, TEST_FILE_NAME, DATA_PATH_TEST)
-    
-    # If the file exist but is not loaded, load it
-    if train_df is None:
-        print("Loading train dataset...")
-        train_df = pd.read_csv(DATA_PATH_TRAIN)
-        train_df['Date'] = pd.to_datetime(train_df['Date'])
-        train_df.sort_values('Date', inplace=True)
-    if test_df is None:
-        print("Loading test dataset...")
-        test_df = pd.read_csv(DATA_PATH_TEST)
-        test_df['Date'] = pd.to_datetime(test_df['Date'])
-        test_df.sort_values('Date', inplace=True)
+    if train_index is None:
+        prefetch_artifacts()
+        train_index = load_dataset(TRAIN_FILE_NAME, DATA_PATH_TRAIN)
+    if test_index is None:
+        # Train y test pueden ser el mismo objeto de S3: se descarga y se procesa una sola vez
+        if TEST_FILE_NAME == TRAIN_FILE_NAME:
+            test_index = train_index
+        else:
+            test_index = load_dataset(TEST_FILE_NAME, DATA_PATH_TEST)
     
     print("All Loaded")
 
+def index_from_arrays(arrays):
+    """
+    Build a (Store, Dept) index over the arrays of a snapshot, already sorted by (Store, Dept, Date).
+    return: dict with 'days' (int32), 'sales' (float32 or None), 'slices' {(store, dept): (start, stop)} and 'version' (content hash)
+    params: arrays (dict from snapshot.to_arrays or snapshot.load_snapshot)
+    """
+    store = arrays['store']
+    dept = arrays['dept']
+    starts = np.flatnonzero(np.r_[True, (store[1:] != store[:-1]) | (dept[1:] != dept[:-1])])
+    stops = np.r_[starts[1:], len(store)]
+    return {
+        'version': cache.content_hash([arrays[column] for column in snapshot.COLUMNS if column in arrays]),
+        'days': arrays['day'],
+        'sales': arrays.get('sales'),
+        'slices': {(int(store[a]), int(dept[a])): (int(a), int(b)) for a, b in zip(starts, stops)},
+    }
+
+def build_series_index(df):
+    """
+    Build a (Store, Dept) index over the dataset, stored as contiguous arrays.
+    return: dict from index_from_arrays
+    params: df (DataFrame with Store, Dept, Date and Weekly_Sales)
+    """
+    return index_from_arrays(snapshot.to_arrays(df))
+
+def get_series(index, store, dept):
+    """
+    Get the dates and sales of a (store, dept) from the index; sales is a view, not a copy.
+    return: (dates, sales) sorted by date, or (None, None) if the series does not exist
+    params: index (dict from build_series_index), store (int), dept (int)
+    """
+    bounds = index['slices'].get((store, dept))
+    if bounds is None:
+        return None, None
+    start, stop = bounds
+    dates = index['days'][start:stop].astype('datetime64[D]')
+    sales = index['sales'][start:stop] if index['sales'] is not None else None
+    return dates, sales
+
 def is_valid_data(input_data):
     """
     Validate the input data.
@@ -107,26 +179,52 @@ def load_data():
 
     return df_train, df_test
 
-# Convertir la serie escalada en secuencias de ventanas (X, y)
-def create_dataset(data, window_size=4):
-    X, y = [], []
-    for i in range(len(data) - window_size):
-        X.append(data[i:i+window_size])
-        y.append(data[i+window_size])
-    return np.array(X), np.array(y)
-
-# Construir y entrenar el modelo LSTM en los datos de entrenamiento
-def build_and_train_model(train_data, window_size=4, epochs=50, batch_size=32):
-    scaler = MinMaxScaler()
-    sales = train_data['Weekly_Sales'].values.reshape(-1, 1)
-    sales_scaled = scaler.fit_transform(sales)
-    X, y_seq = create_dataset(sales_scaled, window_size)
-    model = Sequential()
-    model.add(LSTM(50, activation='relu', input_shape=(window_size, 1)))
-    model.add(Dropout(0.2))
-    model.add(Dense(1))
-    model.compile(optimizer='adam', loss='mse')
-    model.fit(X, y_seq, epochs=epochs, batch_size=batch_size, verbose=0)
+def train_on_demand(sales, window_size=4):
+    """
+    Train a model for a series that is not in the registry.
+    return: dict from lstm_numpy.export_params
+    params: sales (array with the weekly sales of the series), window_size (int)
+    raise: ValueError if training is not available in this image (inference target of the Dockerfile)
+    """
+    # training.py y TensorFlow solo están en la imagen 'train' del Dockerfile
+    try:
+        import training
+    except ImportError as e:
+        raise ValueError(f"Model not in the registry and training is not available: {e}")
+    model, scaler, _ = training.build_and_train_model(sales, window_size=window_size)
+    return lstm_numpy.export_params(model, scaler)
+
+def get_model_params(store, dept, sales, window_size=4):
+    """
+    Get the params of the model of a (store, dept): from the registry if it has one, else train it on demand.
+    return: dict from lstm_numpy.export_params
+    params: store (int), dept (int), sales (array with the weekly sales of the series), window_size (int)
+    raise: ValueError if the model is not in the registry and it can't be trained
+    """
+    key = (store, dept)
+    if key not in loaded_models:
+        if registry.has_entry(store, dept, window_size):
+            print(f"Loading Store {store} Dept {dept} from registry {registry.REGISTRY_VERSION}...")
+            loaded_models[key] = registry.load_entry(store, dept)
+        else:
+            print(f"Store {store} Dept {dept} not in the registry, training on demand...")
+            loaded_models[key] = train_on_demand(sales, window_size=window_size)
+    loaded_models.move_to_end(key)
+    while len(loaded_models) > MODEL_CACHE_SIZE:
+        loaded_models.popitem(last=False)
+    return loaded_models[key]
+
+def get_model(store, dept, sales, window_size=4):
+    """
+    Get the NumPy model and scaler of a (store, dept).
+    return: (model, scaler, sales_scaled)
+    params: store (int), dept (int), sales (array with the weekly sales of the series), window_size (int)
+    """
+    params = get_model_params(store, dept, sales, window_size=window_size)
+    model = lstm_numpy.NumpyLSTM(params)
+    scaler = lstm_numpy.NumpyScaler(params)
+    # Escalar la serie con el scaler ajustado en el entrenamiento
+    sales_scaled = scaler.transform(sales.reshape(-1, 1))
     return model, scaler, sales_scaled
 
 # Obtener las fechas del primer mes de predicción a partir del test
@@ -141,82 +239,71 @@ def get_forecast_dates(test_data):
     return forecast_dates_first_month
 
 # Obtener los últimos días reales del conjunto de entrenamiento
-def get_actual_last(train_data, days=120):
-    last_train_date = train_data['Date'].max()
-    start_date = last_train_date - pd.Timedelta(days=days)
-    actual_last = train_data[train_data['Date'] >= start_date][['Date', 'Weekly_Sales']].copy()
-    actual_last.rename(columns={'Weekly_Sales': 'Sales'}, inplace=True)
+def get_actual_last(dates, sales, days=120):
+    # Las fechas están ordenadas: búsqueda binaria del inicio del período
+    start_date = dates[-1] - np.timedelta64(days, 'D')
+    start = np.searchsorted(dates, start_date, side='left')
+    actual_last = pd.DataFrame({'Date': dates[start:], 'Sales': sales[start:]})
     return actual_last
 
+def model_version(store, dept, window_size=4)->str:
+    """
+    Version of the model that serves a (store, dept), used in the cache keys.
+    return: registry version, or 'on-demand' if the model is trained in the container
+    params: store (int), dept (int), window_size (int)
+    """
+    if registry.has_entry(store, dept, window_size):
+        return registry.REGISTRY_VERSION
+    return 'on-demand'
+
 # Función para generar predicciones in-sample en el conjunto de entrenamiento
 def forecast_on_train(model, scaler, sales_scaled, window_size=4):
-    predictions = []
-    for i in range(window_size, len(sales_scaled)):
-        input_seq = sales_scaled[i-window_size:i].reshape(1, window_size, 1)
-        pred_scaled = model.predict(input_seq, verbose=0)
-        predictions.append(pred_scaled[0, 0])
-    predictions = np.array(predictions).reshape(-1, 1)
-    predictions_inverted = scaler.inverse_transform(predictions)
+    # Todas las ventanas del entrenamiento en un solo lote
+    windows = np.lib.stride_tricks.sliding_window_view(sales_scaled[:-1, 0], window_size)
+    pred_scaled = model(windows.reshape(-1, window_size, 1).astype(np.float32), training=False)
+    predictions_inverted = scaler.inverse_transform(np.asarray(pred_scaled).reshape(-1, 1))
     return predictions_inverted
 
+# Predicción recursiva por lotes: avanza todas las series a la vez con una sola llamada al modelo por paso
+def recursive_forecast(model, windows, n_forecast=30):
+    """
+    Forecast n_forecast steps ahead for a batch of series.
+    return: np.array (n_series, n_forecast) in the scaled space
+    params: model (lstm_numpy.NumpyLSTM or keras model), windows (array (n_series, window_size, 1) with the last scaled values of each series), n_forecast (int)
+    """
+    n_series, window_size, _ = windows.shape
+    # Buffer preasignado: ventana inicial seguida de las predicciones, la ventana de cada paso es una vista
+    buffer = np.empty((n_series, window_size + n_forecast, 1), dtype=np.float32)
+    buffer[:, :window_size] = windows
+    for t in range(n_forecast):
+        pred_scaled = model(buffer[:, t:t + window_size], training=False)
+        buffer[:, window_size + t] = np.asarray(pred_scaled)
+    return buffer[:, window_size:, 0]
+
 # Realizar la predicción recursiva de los siguientes períodos
 def forecast_series(model, scaler, sales_scaled, window_size=4, n_forecast=30):
-    current_sequence = sales_scaled[-window_size:].copy()
-    forecast_scaled = []
-
-    for _ in range(n_forecast):
-        input_seq = current_sequence.reshape(1, window_size, 1)
-        pred_scaled = model.predict(input_seq, verbose=0)
-        forecast_scaled.append(pred_scaled[0, 0])
-
-        # Actualizar la secuencia: eliminar el primer valor e incluir la predicción
-        current_sequence = np.append(current_sequence[1:], [[pred_scaled[0, 0]]], axis=0)
-
-    forecast_full = scaler.inverse_transform(np.array(forecast_scaled).reshape(-1, 1))
+    current_sequence = sales_scaled[-window_size:].reshape(1, window_size, 1)
+    forecast_scaled = recursive_forecast(model, current_sequence, n_forecast=n_forecast)
+    forecast_full = scaler.inverse_transform(forecast_scaled.reshape(-1, 1))
     return forecast_full
 
-#
-
-def build_and_train_model(train_data, window_size=4, epochs=50, batch_size=32):
-    # Escalar la variable 'Weekly_Sales'
-    scaler = MinMaxScaler()
-    sales = train_data['Weekly_Sales'].values.reshape(-1, 1)
-    sales_scaled = scaler.fit_transform(sales)
-
-    # Crear dataset para entrenar el modelo
-    X, y_seq = create_dataset(sales_scaled, window_size)
-
-    # Definir el modelo LSTM
-    model = Sequential()
-    model.add(LSTM(50, activation='relu', input_shape=(window_size, 1)))
-    model.add(Dropout(0.2))
-    model.add(Dense(1))
-    model.compile(optimizer='adam', loss='mse')
-
-    # Entrenar el modelo
-    model.fit(X, y_seq, epochs=epochs, batch_size=batch_size, verbose=0)
-
-    return model, scaler, sales_scaled
-
-
-def process_forecast(store, dept, df_train, df_test, window_size=4, n_forecast=30):
-    # Filtrar datos de train para la tienda y dept especificados
-    train_data = df_train[(df_train['Store'] == store) & (df_train['Dept'] == dept)].copy()
-    train_data.sort_values('Date', inplace=True)
+def process_forecast(store, dept, index, window_size=4, n_forecast=30):
+    # Obtener la serie de la tienda y dept especificados desde el índice
+    dates, sales = get_series(index, store, dept)
 
     # Verificar que haya suficientes datos para entrenar
-    if len(train_data) < window_size + 1:
+    if sales is None or len(sales) < window_size + 1:
         print(f"Datos insuficientes para Store {store} Dept {dept}.")
         return None, None
 
-    # Entrenar el modelo
-    model, scaler, sales_scaled = build_and_train_model(train_data, window_size=window_size)
+    # Cargar el modelo del registro (o entrenarlo si no existe)
+    model, scaler, sales_scaled = get_model(store, dept, sales, window_size=window_size)
 
     # Realizar la predicción recursiva de n_forecast períodos
     forecast_full = forecast_series(model, scaler, sales_scaled, window_size=window_size, n_forecast=n_forecast)
 
     # Obtener los últimos 120 días reales del train
-    actual_last = get_actual_last(train_data, days=120)
+    actual_last = get_actual_last(dates, sales, days=120)
     
     # Obtener las fechas del primer mes predicho a partir del test
     forecast_dates_first_month = add_weekly_forecast(actual_last, forecast_full)
@@ -259,6 +346,153 @@ def add_weekly_forecast(df, forecast_sales):
     
     return updated_df
 
+def serie_to_records(forecasted_serie):
+    """
+    Convert a forecasted serie to JSON serializable records.
+    return: list of dicts with Date (str) and Sales
+    params: forecasted_serie (DataFrame with Date and Sales)
+    """
+    forecasted_serie = forecasted_serie.copy()
+    # Transform the Date column to string
+    forecasted_serie["Date"] = forecasted_serie["Date"].astype(str)
+    return forecasted_serie.to_dict(orient="records")
+
+def forecast_cache_key(store, dept, window_size=4, n_forecast=30)->str:
+    """
+    Cache key of the forecast of a (store, dept) with the loaded data and the model that serves it.
+    return: str
+    params: store (int), dept (int), window_size (int), n_forecast (int)
+    """
+    return cache.make_key(store, dept, train_index['version'], model_version(store, dept, window_size), window_size, n_forecast)
+
+def cached_forecast(store, dept, window_size=4, n_forecast=30):
+    """
+    Forecast of a (store, dept) as records, served from the cache when possible.
+    return: (list of dicts with Date (str) and Sales, cache tier from cache.lookup)
+    params: store (int), dept (int), window_size (int), n_forecast (int)
+    raise: ValueError if the series does not have enough data
+    """
+    key = forecast_cache_key(store, dept, window_size=window_size, n_forecast=n_forecast)
+    records, tier = cache.lookup(key)
+    if records is not None:
+        print(f"Cache hit for Store {store} Dept {dept} ({tier}).")
+        return records, tier
+
+    forecasted_serie = process_forecast(store, dept, train_index, window_size=window_size, n_forecast=n_forecast)
+    if not isinstance(forecasted_serie, pd.DataFrame):
+        raise ValueError(f"Datos insuficientes para Store {store} Dept {dept}.")
+    records = serie_to_records(forecasted_serie)
+    cache.put(key, records)
+    return records, tier
+
+def get_batch_pairs(batch_data):
+    """
+    Get the (store, dept) pairs of a batch request.
+    return: (list of (store, dept), dict {position in the batch: error} of the malformed pairs), or None if batch_data is invalid
+    params: batch_data (list of [dept, store] like "data", or {"store": n} for all the depts of a store)
+    """
+    if isinstance(batch_data, dict) and 'store' in batch_data:
+        try:
+            store = int(batch_data['store'])
+        except (TypeError, ValueError):
+            return None
+        return sorted(key for key in train_index['slices'] if key[0] == store), {}
+    if not isinstance(batch_data, list):
+        return None
+    pairs = []
+    invalid = {}
+    # Un par mal formado se informa en su posición, sin rechazar el resto del lote
+    for position, pair in enumerate(batch_data):
+        try:
+            if not isinstance(pair, list) or len(pair) != INPUT_LEN:
+                raise ValueError
+            dept, store = pair
+            pairs.append((int(store), int(dept)))
+        except (TypeError, ValueError):
+            invalid[position] = f'Invalid pair {pair!r}. Expected [dept, store] integers.'
+    return pairs, invalid
+
+def process_batch_forecast(pairs, window_size=4, n_forecast=30):
+    """
+    Forecast several (store, dept) series together, with one forward pass per step for all of them.
+    return: list of dicts, one per pair, with its prediction or its error and its cache tier
+    params: pairs (list of (store, dept)), window_size (int), n_forecast (int)
+    """
+    results = {}
+    pending = []
+    # Los modelos del lote que no están en memoria se descargan a la vez
+    registry.prefetch_entries([pair for pair in pairs if pair not in loaded_models], window_size)
+    for store, dept in pairs:
+        results[(store, dept)] = {'store': store, 'dept': dept}
+        # Un error en una serie no detiene el resto del lote
+        try:
+            key = forecast_cache_key(store, dept, window_size=window_size, n_forecast=n_forecast)
+            records, results[(store, dept)]['cache'] = cache.lookup(key)
+            if records is not None:
+                results[(store, dept)]['prediction'] = records
+                continue
+            dates, sales = get_series(train_index, store, dept)
+            if sales is None or len(sales) < window_size + 1:
+                raise ValueError(f"Datos insuficientes para Store {store} Dept {dept}.")
+            params = get_model_params(store, dept, sales, window_size=window_size)
+            pending.append((store, dept, key, dates, sales, params))
+        except Exception as e:
+            print(f"Error in Store {store} Dept {dept}: {e}")
+            results[(store, dept)]['error'] = str(e)
+
+    if pending:
+        # Todas las series en un solo lote: cada fila usa los pesos de su propio modelo
+        stacked = lstm_numpy.stack_params([params for *_, params in pending])
+        scaler = lstm_numpy.NumpyScaler(stacked)
+        windows = np.stack([sales[-window_size:] for *_, sales, _ in pending])
+        windows = scaler.transform(windows).reshape(-1, window_size, 1)
+        forecast_scaled = recursive_forecast(lstm_numpy.NumpyLSTM(stacked), windows, n_forecast=n_forecast)
+        forecast_full = scaler.inverse_transform(forecast_scaled)
+        for (store, dept, key, dates, sales, _), forecast in zip(pending, forecast_full):
+            try:
+                actual_last = get_actual_last(dates, sales, days=120)
+                records = serie_to_records(add_weekly_forecast(actual_last, forecast.reshape(-1, 1)))
+                cache.put(key, records)
+                results[(store, dept)]['prediction'] = records
+            except Exception as e:
+                print(f"Error in Store {store} Dept {dept}: {e}")
+                results[(store, dept)]['error'] = str(e)
+    return [results[pair] for pair in pairs]
+
+def handle_batch(batch_data, window_size=4, n_forecast=30):
+    """
+    Handle a batch request.
+    return: JSON response with one result per (store, dept)
+    params: batch_data (value of "batch" in the request body), window_size (int), n_forecast (int)
+    """
+    # Load the DATA if not already loaded
+    print('Loading files...')
+    load_files_from_s3()
+
+    parsed = get_batch_pairs(batch_data)
+    if parsed is None or not (parsed[0] or parsed[1]):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. Provide a list of [dept, store] pairs or {{"store": n}} in "batch".'})
+        }
+    pairs, invalid = parsed
+    if len(pairs) + len(invalid) > MAX_BATCH_SIZE:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'ERROR': f'Invalid input. A batch can have up to {MAX_BATCH_SIZE} series.'})
+        }
+
+    print(f'Making batch forecast of {len(pairs)} series...')
+    results = process_batch_forecast(pairs, window_size=window_size, n_forecast=n_forecast) if pairs else []
+    # Los pares mal formados vuelven en su posición del lote, con su error
+    for position in sorted(invalid):
+        results.insert(position, {'input': batch_data[position], 'error': invalid[position]})
+    return {
+        'statusCode': 200,
+        'headers': cache.headers([result['cache'] for result in results if 'cache' in result]),
+        'body': json.dumps({'predictions': results})
+    }
+
 def lambda_handler(event, _):
     """
     Lambda function handler.
@@ -266,19 +500,22 @@ def lambda_handler(event, _):
     params: event (API Gateway input), context (Lambda context)
     raise: Exception if the input data is invalid or the model fails
     """
-    global train_df
-    global test_df
+    global train_index
     global status_error
 
     # Set the window size and number of forecast periods
     window_size = 4
     n_forecast = 30
 
+    input_data = None
     try:
         body = event.get("body")
         if body:
             # Parse the JSON string
             parsed_body = json.loads(body)
+            # Batch mode: several (store, dept) series in one request
+            if "batch" in parsed_body:
+                return handle_batch(parsed_body["batch"], window_size=window_size, n_forecast=n_forecast)
             # Access the "features" key inside "data"
             input_data = parsed_body.get("data")
             # Get the type and length of the input data
@@ -302,16 +539,13 @@ def lambda_handler(event, _):
 
             # Make the forecast
             print('Making forecast...')
-            forecasted_serie = process_forecast(store, dept, train_df, test_df, window_size=window_size, n_forecast=n_forecast)
-            print(f"Train Predictions: {forecasted_serie}")
+            json_response, tier = cached_forecast(store, dept, window_size=window_size, n_forecast=n_forecast)
+            print(f"Train Predictions: {json_response}")
             
-            # Transform the Date column to string
-            forecasted_serie["Date"] = forecasted_serie["Date"].astype(str)
-            # Convert the DataFrame to a list of dictionaries
-            json_response = forecasted_serie.to_dict(orient="records")
             # Return the prediction
             return {
                 'statusCode': 200,
+                'headers': cache.headers([tier]),
                 'body': json.dumps({'prediction': json_response})
             }
         else:
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+from botocore.exceptions import ClientError
+import lstm_numpy
+from common import artifacts
+
+# Local root of the model registry (one folder per version)
+REGISTRY_PATH:str = os.environ.get('REGISTRY_PATH', '/tmp/registry')
+# Version served by the Lambda
+REGISTRY_VERSION:str = os.environ.get('REGISTRY_VERSION', 'v2')
+# S3 location of the registry
+S3_BUCKET: str = 'myawzbucket'
+S3_REGISTRY_PREFIX:str = 'time/registry'
+
+MANIFEST_NAME:str = 'manifest.json'
+# Seconds a missing manifest is remembered before asking S3 again
+MANIFEST_MISS_TTL:int = int(os.environ.get('REGISTRY_MISS_TTL', '300'))
+# Format of the entries: one .npz per model with the weights and the scaler (lstm_numpy)
+REGISTRY_FORMAT:str = 'npz'
+
+s3 = artifacts.s3
+
+# Manifests already read, by version (None if the version was not found)
+manifests:dict = {}
+# When each missing manifest was last looked up (time.monotonic)
+missing_since:dict = {}
+
+def entry_name(store, dept)->str:
+    """
+    Name used for the files of a (store, dept) model.
+    return: str
+    params: store (int), dept (int)
+    """
+    return f'store_{int(store)}_dept_{int(dept)}'
+
+def version_path(version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->str:
+    """
+    Local folder of a registry version.
+    return: str
+    params: version (str), registry_path (str)
+    """
+    return os.path.join(registry_path, version)
+
+def entry_path(store, dept, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->str:
+    """
+    Local path of the exported model of a (store, dept).
+    return: str
+    params: store (int), dept (int), version (str), registry_path (str)
+    """
+    return os.path.join(version_path(version, registry_path), f'{entry_name(store, dept)}.npz')
+
+def save_entry(store, dept, params, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->str:
+    """
+    Save the exported model (weights and scaler) of a (store, dept).
+    return: path of the entry
+    params: store (int), dept (int), params (dict from lstm_numpy.export_params), version (str), registry_path (str)
+    """
+    path = entry_path(store, dept, version, registry_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lstm_numpy.save_params(params, path)
+    return path
+
+def write_manifest(entries, window_size, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->str:
+    """
+    Write the manifest listing every (store, dept) in a registry version.
+    return: manifest path
+    params: entries (list of (store, dept)), window_size (int), version (str), registry_path (str)
+    """
+    manifest = {
+        'version': version,
+        'format': REGISTRY_FORMAT,
+        'window_size': window_size,
+        'entries': sorted(entry_name(store, dept) for store, dept in entries),
+    }
+    path = os.path.join(version_path(version, registry_path), MANIFEST_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+    manifests[(registry_path, version)] = manifest
+    return path
+
+def upload_version(version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->None:
+    """
+    Upload a local registry version to S3.
+    return: None
+    params: version (str), registry_path (str)
+    """
+    local_dir = version_path(version, registry_path)
+    for file_name in sorted(os.listdir(local_dir)):
+        s3_path = f'{S3_REGISTRY_PREFIX}/{version}/{file_name}'
+        artifacts.upload_file(os.path.join(local_dir, file_name), s3_path, S3_BUCKET)
+    print(f'Registry {version} uploaded to {S3_BUCKET}/{S3_REGISTRY_PREFIX}/{version}')
+
+def file_artifact(local_path, version=REGISTRY_VERSION)->artifacts.Artifact:
+    """
+    Registry file in S3 for a local path.
+    return: artifacts.Artifact (optional: a missing entry is trained on demand)
+    params: local_path (str), version (str)
+    """
+    s3_path = f'{S3_REGISTRY_PREFIX}/{version}/{os.path.basename(local_path)}'
+    return artifacts.Artifact(s3_path, local_path, S3_BUCKET, optional=True)
+
+def manifest_artifact(version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->artifacts.Artifact:
+    return file_artifact(os.path.join(version_path(version, registry_path), MANIFEST_NAME), version)
+
+def fetch_file(local_path, version=REGISTRY_VERSION)->bool:
+    """
+    Download a registry file from S3 if it's not already on disk.
+    return: True if the file is available locally
+    params: local_path (str), version (str)
+    """
+    try:
+        return artifacts.ensure([file_artifact(local_path, version)])[local_path]
+    except ClientError as e:
+        print(f'Registry file {local_path} not available: {e}')
+        return False
+
+def prefetch_entries(pairs, window_size, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->None:
+    """
+    Download the entries of several (store, dept) concurrently.
+    return: None
+    params: pairs (list of (store, dept)), window_size (int), version (str), registry_path (str)
+    """
+    declared = [file_artifact(entry_path(store, dept, version, registry_path), version)
+                for store, dept in pairs if has_entry(store, dept, window_size, version, registry_path)]
+    try:
+        artifacts.ensure(declared)
+    except ClientError as e:
+        print(f'Registry prefetch incomplete: {e}')
+
+def load_manifest(version=REGISTRY_VERSION, registry_path=REGISTRY_PATH):
+    """
+    Load the manifest of a registry version, downloading it if needed.
+    return: manifest dict, or None if the version does not exist
+    params: version (str), registry_path (str)
+    """
+    key = (registry_path, version)
+    if key in manifests and manifests[key] is None and time.monotonic() - missing_since[key] >= MANIFEST_MISS_TTL:
+        # Pasado el TTL se vuelve a buscar: la versión puede haberse subido después
+        del manifests[key]
+    if key not in manifests:
+        path = os.path.join(version_path(version, registry_path), MANIFEST_NAME)
+        if not fetch_file(path, version):
+            # Sin registro: no repetir la consulta a S3 en cada petición
+            manifests[key] = None
+            missing_since[key] = time.monotonic()
+            return None
+        with open(path) as f:
+            manifests[key] = json.load(f)
+    return manifests[key]
+
+def has_entry(store, dept, window_size, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->bool:
+    """
+    Check if the registry has a model for (store, dept) trained with window_size.
+    return: bool
+    params: store (int), dept (int), window_size (int), version (str), registry_path (str)
+    """
+    manifest = load_manifest(version, registry_path)
+    if manifest is None or manifest.get('format') != REGISTRY_FORMAT or manifest['window_size'] != window_size:
+        return False
+    return entry_name(store, dept) in manifest['entries']
+
+def load_entry(store, dept, version=REGISTRY_VERSION, registry_path=REGISTRY_PATH)->dict:
+    """
+    Load the exported model of a (store, dept).
+    return: dict from lstm_numpy.load_params
+    params: store (int), dept (int), version (str), registry_path (str)
+    raise: FileNotFoundError if the version or the entry file is missing
+    """
+    path = entry_path(store, dept, version, registry_path)
+    if load_manifest(version, registry_path) is None or not fetch_file(path, version):
+        raise FileNotFoundError(path)
+    return lstm_numpy.load_params(path)
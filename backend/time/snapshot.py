@@ -0,0 +1,125 @@
+"""
+Typed binary snapshot of the sales dataset.
+
+The CSV is converted offline into one .npy file per column, sorted by
+(Store, Dept, Date), so the Lambda can memory-map it instead of parsing CSV:
+
+    store.npy  int16
+    dept.npy   int16
+    day.npy    int32   days since 1970-01-01
+    sales.npy  float32 (only if the CSV has Weekly_Sales)
+
+Usage:
+    python snapshot.py cleaned_data.csv --upload
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+from common import artifacts
+
+S3_BUCKET: str = 'myawzbucket'
+S3_SNAPSHOT_PREFIX:str = 'time/snapshot'
+# Local folder for the snapshots in the Lambda env
+SNAPSHOT_PATH:str = '/tmp/snapshot'
+
+COLUMNS:tuple = ('store', 'dept', 'day', 'sales')
+
+s3 = artifacts.s3
+
+def snapshot_name(file_name)->str:
+    """
+    Name of the snapshot of a dataset file.
+    return: str
+    params: file_name (str, e.g. 'cleaned_data.csv')
+    """
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+def to_arrays(df)->dict:
+    """
+    Convert the dataset to typed arrays sorted by (Store, Dept, Date).
+    return: dict {column: np.array}
+    params: df (DataFrame with Store, Dept, Date and optionally Weekly_Sales)
+    """
+    store = df['Store'].to_numpy(dtype=np.int16)
+    dept = df['Dept'].to_numpy(dtype=np.int16)
+    day = pd.to_datetime(df['Date']).to_numpy().astype('datetime64[D]').astype(np.int32)
+    order = np.lexsort((day, dept, store))
+    arrays = {'store': store[order], 'dept': dept[order], 'day': day[order]}
+    # El test puede no tener ventas, solo fechas
+    if 'Weekly_Sales' in df.columns:
+        arrays['sales'] = df['Weekly_Sales'].to_numpy(dtype=np.float32)[order]
+    return arrays
+
+def save_snapshot(arrays, path)->None:
+    """
+    Write the arrays of a snapshot as .npy files.
+    return: None
+    params: arrays (dict from to_arrays), path (folder)
+    """
+    os.makedirs(path, exist_ok=True)
+    for column, values in arrays.items():
+        np.save(os.path.join(path, f'{column}.npy'), values)
+
+def load_snapshot(path)->dict:
+    """
+    Memory-map the arrays of a snapshot.
+    return: dict {column: read-only np.memmap}
+    params: path (folder)
+    """
+    arrays = {}
+    for column in COLUMNS:
+        file_path = os.path.join(path, f'{column}.npy')
+        if os.path.exists(file_path):
+            arrays[column] = np.load(file_path, mmap_mode='r')
+    return arrays
+
+def snapshot_artifacts(name, path)->list:
+    """
+    Files of a snapshot in S3 (only the sales are optional).
+    return: list of artifacts.Artifact
+    params: name (str), path (local folder)
+    """
+    return [artifacts.Artifact(f'{S3_SNAPSHOT_PREFIX}/{name}/{column}.npy', os.path.join(path, f'{column}.npy'), S3_BUCKET,
+                               optional=column == 'sales') for column in COLUMNS]
+
+def download_snapshot(name, path)->bool:
+    """
+    Download a snapshot from S3 if it's not already on disk (all its columns at once).
+    return: True if the snapshot is available locally
+    params: name (str), path (local folder)
+    """
+    try:
+        artifacts.ensure(snapshot_artifacts(name, path))
+    except ClientError as e:
+        print(f'Snapshot {name} not available: {e}')
+        return False
+    return True
+
+def upload_snapshot(name, path)->None:
+    """
+    Upload a local snapshot to S3.
+    return: None
+    params: name (str), path (local folder)
+    """
+    for column in COLUMNS:
+        file_path = os.path.join(path, f'{column}.npy')
+        if os.path.exists(file_path):
+            artifacts.upload_file(file_path, f'{S3_SNAPSHOT_PREFIX}/{name}/{column}.npy', S3_BUCKET)
+    print(f'Snapshot uploaded to {S3_BUCKET}/{S3_SNAPSHOT_PREFIX}/{name}')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a sales CSV into a binary snapshot.')
+    parser.add_argument('csv', help='CSV with Store, Dept, Date and Weekly_Sales')
+    parser.add_argument('--out', default=None, help='Output folder (default: ./snapshot/<name>)')
+    parser.add_argument('--upload', action='store_true', help='Upload the snapshot to S3 when done')
+    args = parser.parse_args()
+
+    name = snapshot_name(args.csv)
+    out = args.out or os.path.join('snapshot', name)
+    arrays = to_arrays(pd.read_csv(args.csv))
+    save_snapshot(arrays, out)
+    print(f'Snapshot {name}: {len(arrays["day"])} rows saved in {out}')
+    if args.upload:
+        upload_snapshot(name, out)
@@ -0,0 +1,60 @@
+"""
+Offline job that fills the forecast model registry.
+
+Trains one LSTM per (Store, Dept) with build_and_train_model, exports its
+weights and scaler to the NumPy format served by the Lambda (checking parity
+against keras) and saves them under REGISTRY_PATH/<version>.
+
+Usage:
+    python train_registry.py --data cleaned_data.csv --version v1 --upload
+"""
+import argparse
+import pandas as pd
+import registry
+import lstm_numpy
+from training import build_and_train_model
+from main import build_series_index, get_series
+
+def train_registry(df_train, version, registry_path, window_size=4, epochs=50, batch_size=32):
+    """
+    Train and save one model per (Store, Dept) of the dataset.
+    return: list of (store, dept) saved in the registry
+    params: df_train (DataFrame), version (str), registry_path (str), window_size (int), epochs (int), batch_size (int)
+    """
+    entries = []
+    index = build_series_index(df_train)
+    pairs = sorted(index['slices'])
+    for i, (store, dept) in enumerate(pairs, start=1):
+        _, sales = get_series(index, store, dept)
+        # Mismo criterio que process_forecast para series muy cortas
+        if len(sales) < window_size + 1:
+            print(f"Datos insuficientes para Store {store} Dept {dept}.")
+            continue
+        model, scaler, _ = build_and_train_model(sales, window_size=window_size, epochs=epochs, batch_size=batch_size)
+        params = lstm_numpy.export_params(model, scaler)
+        # La Lambda sirve con lstm_numpy: verificar que da lo mismo que keras
+        lstm_numpy.check_parity(model, params, window_size=window_size)
+        registry.save_entry(store, dept, params, version, registry_path)
+        entries.append((store, dept))
+        print(f"[{i}/{len(pairs)}] Store {store} Dept {dept} saved.")
+
+    registry.write_manifest(entries, window_size, version, registry_path)
+    return entries
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train the per-(Store, Dept) forecast models.')
+    parser.add_argument('--data', default='cleaned_data.csv', help='CSV with Store, Dept, Date and Weekly_Sales')
+    parser.add_argument('--version', default=registry.REGISTRY_VERSION)
+    parser.add_argument('--registry', default=registry.REGISTRY_PATH)
+    parser.add_argument('--window-size', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=50)
+    parser.add_argument('--upload', action='store_true', help='Upload the version to S3 when done')
+    args = parser.parse_args()
+
+    df_train = pd.read_csv(args.data)
+    df_train['Date'] = pd.to_datetime(df_train['Date'])
+
+    entries = train_registry(df_train, args.version, args.registry, window_size=args.window_size, epochs=args.epochs)
+    print(f"{len(entries)} models saved in registry {args.version}.")
+    if args.upload:
+        registry.upload_version(args.version, args.registry)
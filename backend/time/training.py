@@ -0,0 +1,41 @@
+"""
+Training of the forecast LSTM. Needs TensorFlow and scikit-learn
+(requirements-train.txt); the Lambda only imports it to train on demand.
+"""
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
+import tensorflow as tf
+from tensorflow.keras.models import Sequential # type: ignore
+from tensorflow.keras.layers import LSTM, Dense, Dropout # type: ignore
+
+# Convertir la serie escalada en secuencias de ventanas (X, y)
+def create_dataset(data, window_size=4):
+    X, y = [], []
+    for i in range(len(data) - window_size):
+        X.append(data[i:i+window_size])
+        y.append(data[i+window_size])
+    return np.array(X), np.array(y)
+
+# Definir el modelo LSTM (misma arquitectura que reproduce lstm_numpy)
+def build_model(window_size=4):
+    model = Sequential()
+    model.add(LSTM(50, activation='relu', input_shape=(window_size, 1)))
+    model.add(Dropout(0.2))
+    model.add(Dense(1))
+    model.compile(optimizer='adam', loss='mse')
+    return model
+
+# Construir y entrenar el modelo LSTM en los datos de entrenamiento
+def build_and_train_model(sales, window_size=4, epochs=50, batch_size=32):
+    # Escalar la variable 'Weekly_Sales'
+    scaler = MinMaxScaler()
+    sales_scaled = scaler.fit_transform(sales.reshape(-1, 1))
+
+    # Crear dataset para entrenar el modelo
+    X, y_seq = create_dataset(sales_scaled, window_size)
+
+    # Entrenar el modelo
+    model = build_model(window_size)
+    model.fit(X, y_seq, epochs=epochs, batch_size=batch_size, verbose=0)
+
+    return model, scaler, sales_scaled
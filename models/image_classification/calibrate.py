@@ -0,0 +1,134 @@
+"""
+Calibration of the image classifier and generation of class_labels.json.
+
+Reads held-out images with one folder per class (the same layout as
+flow_from_directory), fits the temperature that minimizes the log-loss of the
+model probabilities and picks the confidence threshold above which the
+predictions reach a target accuracy. The result is the images/class_labels.json
+artifact read by backend/images/main.py.
+
+Usage (--upload needs backend/ in the PYTHONPATH for the shared artifact manager):
+    PYTHONPATH=../../backend python calibrate.py modelo_ecommerce_v2.h5 validacion/ --target-accuracy 0.98 --upload
+"""
+import os
+import io
+import json
+import argparse
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE:tuple = (244, 244)
+IMAGE_EXTENSIONS:tuple = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+S3_BUCKET:str = 'myawzbucket'
+S3_PATH_LABELS:str = 'images/class_labels.json'
+
+def decode_image(data):
+    """
+    Decode an image like the Lambda (RGB, nearest resize to 244x244) scaled to [0, 1].
+    return: np.array (244, 244, 3) float32
+    params: data (bytes)
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.asarray(img.resize(IMAGE_SIZE[::-1], Image.NEAREST), dtype=np.float32) / 255.0
+
+def load_image_folder(path, labels=None):
+    """
+    Load a folder with one subfolder per class.
+    return: (images (n, 244, 244, 3) float32, targets (n,) int, labels list of str)
+    params: path (str), labels (list of str in the order of the model outputs, default: sorted subfolders)
+    """
+    labels = labels or sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+    images, targets = [], []
+    for target, label in enumerate(labels):
+        folder = os.path.join(path, label)
+        for file_name in sorted(os.listdir(folder)):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                with open(os.path.join(folder, file_name), 'rb') as f:
+                    images.append(decode_image(f.read()))
+                targets.append(target)
+    return np.stack(images), np.array(targets), labels
+
+def predict_probabilities(model, images, batch_size=32):
+    """
+    Softmax outputs of the model for a set of images.
+    return: np.array (n, n_classes)
+    params: model (keras model), images (np.array), batch_size (int)
+    """
+    return np.concatenate([np.asarray(model(images[start:start + batch_size], training=False))
+                           for start in range(0, len(images), batch_size)])
+
+def apply_temperature(probabilities, temperature):
+    """
+    Same temperature scaling as backend/images/main.py calibrate.
+    return: np.array (n, n_classes)
+    params: probabilities (np.array (n, n_classes)), temperature (float)
+    """
+    logits = np.log(np.clip(probabilities, 1e-12, None)) / temperature
+    logits -= logits.max(axis=1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=1, keepdims=True)
+
+def log_loss(probabilities, targets):
+    return float(-np.mean(np.log(np.clip(probabilities[np.arange(len(targets)), targets], 1e-12, None))))
+
+def fit_temperature(probabilities, targets):
+    """
+    Temperature with the lowest log-loss, searched on a log grid and refined around the best value.
+    return: float
+    params: probabilities (np.array (n, n_classes)), targets (np.array (n,) int)
+    """
+    grid = np.exp(np.linspace(np.log(0.05), np.log(20.0), 200))
+    best = min(grid, key=lambda t: log_loss(apply_temperature(probabilities, t), targets))
+    fine = np.linspace(best * 0.9, best * 1.1, 101)
+    return float(min(fine, key=lambda t: log_loss(apply_temperature(probabilities, t), targets)))
+
+def choose_threshold(probabilities, targets, target_accuracy):
+    """
+    Lowest confidence threshold at which the predictions above it reach the target accuracy.
+    return: float (1.0 if no threshold reaches it)
+    params: probabilities (calibrated np.array (n, n_classes)), targets (np.array (n,) int), target_accuracy (float)
+    """
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == targets
+    order = np.argsort(-confidence)
+    # Precisión acumulada de las predicciones más seguras primero
+    accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    reached = np.flatnonzero(accuracy >= target_accuracy)
+    if not len(reached):
+        return 1.0
+    return float(confidence[order][reached[-1]])
+
+if __name__ == "__main__":
+    import tensorflow as tf
+
+    parser = argparse.ArgumentParser(description='Calibrate the image classifier and write class_labels.json.')
+    parser.add_argument('model', help='Keras .h5 model')
+    parser.add_argument('data', help='Held-out images, one folder per class')
+    parser.add_argument('--labels', nargs='+', default=None, help='Class labels in the order of the model outputs')
+    parser.add_argument('--target-accuracy', type=float, default=0.98)
+    parser.add_argument('--out', default='class_labels.json')
+    parser.add_argument('--upload', action='store_true', help=f'Upload to s3://{S3_BUCKET}/{S3_PATH_LABELS}')
+    args = parser.parse_args()
+
+    model = tf.keras.models.load_model(args.model)
+    images, targets, labels = load_image_folder(args.data, args.labels)
+    probabilities = predict_probabilities(model, images)
+
+    temperature = fit_temperature(probabilities, targets)
+    calibrated = apply_temperature(probabilities, temperature)
+    threshold = choose_threshold(calibrated, targets, args.target_accuracy)
+    low = calibrated.max(axis=1) < threshold
+    print(f"Images: {len(targets)}, accuracy: {np.mean(probabilities.argmax(axis=1) == targets):.4f}")
+    print(f"Temperature: {temperature:.3f}, log-loss {log_loss(probabilities, targets):.4f} -> {log_loss(calibrated, targets):.4f}")
+    print(f"Threshold: {threshold:.3f}, low confidence: {low.mean():.1%} of the images")
+
+    with open(args.out, 'w') as f:
+        json.dump({'labels': labels, 'temperature': temperature, 'confidence_threshold': threshold}, f, indent=2)
+    print(f"Saved {args.out}")
+    if args.upload:
+        # Con el sha256 como metadata, la Lambda verifica el archivo al descargarlo (PYTHONPATH=../../backend)
+        from common import artifacts
+        artifacts.upload_file(args.out, S3_PATH_LABELS, S3_BUCKET)
+        print(f"Uploaded to {S3_BUCKET}/{S3_PATH_LABELS}")
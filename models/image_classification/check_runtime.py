@@ -0,0 +1,60 @@
+"""
+Runs exported TFLite models with the tflite-runtime of the Lambda image.
+
+The models are converted with TensorFlow (backend/images/requirements.txt) but
+the lightweight image serves them with tflite-runtime
+(backend/images/requirements-tflite.txt), which rejects op versions newer than
+the ones it knows. This script only needs numpy and tflite-runtime, so it runs
+in a separate environment with requirements-tflite.txt installed; export_tflite.py
+calls it with --runtime-python and adds the result to report.json.
+
+Usage:
+    python check_runtime.py tflite/model_images_fp16.tflite tflite/model_images_int8.tflite --inputs inputs.npy --out outputs.npz
+"""
+import os
+import json
+import argparse
+import numpy as np
+import tflite_runtime
+import tflite_runtime.interpreter as tflite
+
+def run_model(path, inputs, batch_size=32):
+    """
+    Outputs of a TFLite model for a set of images, run with tflite-runtime.
+    return: np.array (n, n_classes)
+    params: path (str), inputs (np.array (n, 244, 244, 3) float32), batch_size (int)
+    raise: ValueError/RuntimeError if the runtime can't load or run the model
+    """
+    interpreter = tflite.Interpreter(model_path=path)
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+    outputs = []
+    for start in range(0, len(inputs), batch_size):
+        batch = np.ascontiguousarray(inputs[start:start + batch_size], dtype=np.float32)
+        interpreter.resize_tensor_input(input_index, batch.shape)
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, batch)
+        interpreter.invoke()
+        outputs.append(interpreter.get_tensor(output_index).copy())
+    return np.concatenate(outputs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run TFLite models with tflite-runtime.')
+    parser.add_argument('models', nargs='+', help='.tflite files')
+    parser.add_argument('--inputs', required=True, help='.npy with the input images')
+    parser.add_argument('--out', required=True, help='.npz with the outputs of every model that loads')
+    args = parser.parse_args()
+
+    inputs = np.load(args.inputs)
+    outputs = {}
+    status = {'tflite_runtime': tflite_runtime.__version__, 'models': {}}
+    for path in args.models:
+        name = os.path.basename(path)
+        try:
+            outputs[name] = run_model(path, inputs)
+            status['models'][name] = {'loads': True}
+        except (ValueError, RuntimeError) as e:
+            # Versiones de operaciones que el runtime no conoce
+            status['models'][name] = {'loads': False, 'error': str(e)}
+    np.savez(args.out, **outputs)
+    print(json.dumps(status))
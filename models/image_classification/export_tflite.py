@@ -0,0 +1,194 @@
+"""
+TFLite export of the image classifier and accuracy vs latency report.
+
+Converts the trained Keras .h5 model with post-training quantization:
+
+    model_images_fp16.tflite   float16 weights
+    model_images_int8.tflite   int8 weights and activations, calibrated with
+                               representative images (float32 input and output,
+                               so the Lambda feeds it the same batch as the .h5)
+
+and compares every variant with the .h5 on a held-out set (one folder per
+class): accuracy, agreement with the .h5, latency per image and file size.
+backend/images/main.py serves the TFLite models with MODEL_BACKEND=tflite.
+The Lambda image pins tflite-runtime 2.14.0: a model converted with a newer
+TensorFlow loads only if its op versions are known to that runtime. With
+--runtime-python the exported models are also run with that runtime
+(check_runtime.py) and the result is written to report.json as runtime_check.
+
+Usage (--upload needs backend/ in the PYTHONPATH for the shared artifact manager):
+    PYTHONPATH=../../backend python export_tflite.py modelo_ecommerce_v2.h5 --calibration entrenamiento/ --test validacion/ --runtime-python tflite-env/bin/python --upload
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from calibrate import load_image_folder, predict_probabilities, S3_BUCKET
+
+S3_PREFIX:str = 'images'
+VARIANTS:tuple = ('fp16', 'int8')
+
+def convert(model, variant, calibration_images=None)->bytes:
+    """
+    Convert a keras model to TFLite.
+    return: flatbuffer bytes
+    params: model (keras model), variant ('fp16' or 'int8'), calibration_images (np.array (n, 244, 244, 3), needed for int8)
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == 'fp16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        # Rangos de las activaciones calculados con imágenes reales
+        def representative_dataset():
+            for img in calibration_images:
+                yield [img[None].astype(np.float32)]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError(f'Unknown variant {variant}')
+    return converter.convert()
+
+class TFLiteModel:
+    """
+    Same wrapper as backend/images/main.py: model(x, training=False) over a TFLite interpreter.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def __call__(self, x, training=False):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, x.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = x.shape[0]
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+def latency_ms(model, images, repeats=1):
+    """
+    Latency of one-image calls, as the single-image Lambda path runs them.
+    return: dict with the mean, p50 and p95 in ms
+    params: model (callable), images (np.array), repeats (int)
+    """
+    model(images[:1], training=False)
+    times = []
+    for _ in range(repeats):
+        for img in images:
+            start_time = time.perf_counter()
+            model(img[None], training=False)
+            times.append((time.perf_counter() - start_time) * 1000)
+    return {'mean_ms': float(np.mean(times)), 'p50_ms': float(np.percentile(times, 50)), 'p95_ms': float(np.percentile(times, 95))}
+
+def compare(models, sizes, images, targets):
+    """
+    Accuracy vs latency of every variant on a held-out set.
+    return: dict {variant: metrics}
+    params: models (dict {variant: callable}, with an 'h5' entry), sizes (dict {variant: bytes}), images (np.array), targets (np.array)
+    """
+    reference = predict_probabilities(models['h5'], images).argmax(axis=1)
+    report = {}
+    for variant, model in models.items():
+        predictions = predict_probabilities(model, images).argmax(axis=1)
+        report[variant] = {
+            'accuracy': float(np.mean(predictions == targets)),
+            'agreement_with_h5': float(np.mean(predictions == reference)),
+            'size_mb': sizes[variant] / 2 ** 20,
+            **latency_ms(model, images),
+        }
+    return report
+
+def check_runtime(runtime_python, paths, models, images, out):
+    """
+    Run the exported models with the tflite-runtime of the Lambda image (check_runtime.py in
+    another environment) and compare them with the TensorFlow interpreter and with the .h5.
+    return: dict with the tensorflow and tflite_runtime versions and, per variant, whether it loads
+            and its max abs difference with TensorFlow and agreement with the .h5
+    params: runtime_python (python of an environment with requirements-tflite.txt), paths (dict {variant: .tflite path}),
+            models (dict {variant: callable}, with an 'h5' entry), images (np.array), out (folder for the temporary files)
+    raise: subprocess.CalledProcessError if check_runtime.py fails
+    """
+    import subprocess
+    inputs_path = os.path.join(out, 'runtime_inputs.npy')
+    outputs_path = os.path.join(out, 'runtime_outputs.npz')
+    np.save(inputs_path, images.astype(np.float32))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_runtime.py')
+    result = subprocess.run([runtime_python, script, *paths.values(), '--inputs', inputs_path, '--out', outputs_path],
+                            check=True, capture_output=True, text=True)
+    status = json.loads(result.stdout.strip().splitlines()[-1])
+    reference = predict_probabilities(models['h5'], images).argmax(axis=1)
+    report = {'tensorflow': tf.__version__, 'tflite_runtime': status['tflite_runtime'], 'samples': len(images)}
+    with np.load(outputs_path) as outputs:
+        for variant, path in paths.items():
+            name = os.path.basename(path)
+            report[variant] = status['models'][name]
+            if name in outputs:
+                runtime_outputs = outputs[name]
+                report[variant]['max_abs_diff_with_tensorflow'] = float(np.abs(runtime_outputs - predict_probabilities(models[variant], images)).max())
+                report[variant]['agreement_with_h5'] = float(np.mean(runtime_outputs.argmax(axis=1) == reference))
+    os.remove(inputs_path)
+    os.remove(outputs_path)
+    return report
+
+def print_report(report):
+    print(f"{'variant':<8} {'accuracy':>9} {'agree_h5':>9} {'size_mb':>8} {'mean_ms':>8} {'p50_ms':>8} {'p95_ms':>8}")
+    for variant, metrics in report.items():
+        print(f"{variant:<8} {metrics['accuracy']:>9.4f} {metrics['agreement_with_h5']:>9.4f} {metrics['size_mb']:>8.2f} "
+              f"{metrics['mean_ms']:>8.2f} {metrics['p50_ms']:>8.2f} {metrics['p95_ms']:>8.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the image classifier to TFLite and compare it with the .h5.')
+    parser.add_argument('model', help='Keras .h5 model')
+    parser.add_argument('--calibration', required=True, help='Representative images for int8, one folder per class')
+    parser.add_argument('--calibration-size', type=int, default=200, help='Max number of calibration images')
+    parser.add_argument('--test', required=True, help='Held-out images, one folder per class')
+    parser.add_argument('--labels', nargs='+', default=None, help='Class labels in the order of the model outputs')
+    parser.add_argument('--out', default='tflite', help='Output folder')
+    parser.add_argument('--runtime-python', default=None,
+                        help='Python of an environment with backend/images/requirements-tflite.txt, to check the models with tflite-runtime')
+    parser.add_argument('--runtime-samples', type=int, default=64, help='Held-out images used in the tflite-runtime check')
+    parser.add_argument('--upload', action='store_true', help=f'Upload the TFLite models to s3://{S3_BUCKET}/{S3_PREFIX}/')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    model = tf.keras.models.load_model(args.model)
+    calibration_images, _, _ = load_image_folder(args.calibration, args.labels)
+    rng = np.random.default_rng(0)
+    calibration_images = calibration_images[rng.permutation(len(calibration_images))[:args.calibration_size]]
+
+    models = {'h5': model}
+    sizes = {'h5': os.path.getsize(args.model)}
+    paths = {}
+    for variant in VARIANTS:
+        path = paths[variant] = os.path.join(args.out, f'model_images_{variant}.tflite')
+        with open(path, 'wb') as f:
+            f.write(convert(model, variant, calibration_images))
+        models[variant] = TFLiteModel(path)
+        sizes[variant] = os.path.getsize(path)
+        print(f"Saved {path}")
+
+    images, targets, _ = load_image_folder(args.test, args.labels)
+    report = compare(models, sizes, images, targets)
+    print_report(report)
+    if args.runtime_python:
+        # Mismo runtime que la imagen ligera de la Lambda
+        report['runtime_check'] = check_runtime(args.runtime_python, paths, models, images[:args.runtime_samples], args.out)
+        print(json.dumps(report['runtime_check'], indent=2))
+    with open(os.path.join(args.out, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.upload:
+        if 'runtime_check' in report and not all(report['runtime_check'][variant]['loads'] for variant in VARIANTS):
+            raise SystemExit('tflite-runtime can not load every model, not uploading (see runtime_check in report.json)')
+        # Con el sha256 como metadata, la Lambda verifica los modelos al descargarlos (PYTHONPATH=../../backend)
+        from common import artifacts
+        for variant in VARIANTS:
+            artifacts.upload_file(os.path.join(args.out, f'model_images_{variant}.tflite'), f'{S3_PREFIX}/model_images_{variant}.tflite', S3_BUCKET)
+        print(f"Uploaded to {S3_BUCKET}/{S3_PREFIX}/")
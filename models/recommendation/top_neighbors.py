@@ -0,0 +1,163 @@
+"""
+Top-k neighbors of every product, without the dense N x N similarity matrix.
+
+Builds the top_k_neighbors.pkl artifact used by backend/recommendation/main.py
+from the frame of Explo.ipynb (the one with the 'search_terms' column). The
+cosine similarities are computed from the sparse CountVectorizer matrix in
+blocks of rows and the top-k of each block is taken with argpartition, so
+memory is bounded by block_size x N instead of N x N.
+
+Usage:
+    python top_neighbors.py frame.pkl --out top_k_neighbors.pkl --jobs 4 --benchmark 5000
+"""
+import time
+import pickle
+import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+
+# Matriz normalizada compartida por los procesos del pool
+_shared = {}
+
+def vectorize(search_terms):
+    """
+    Same CountVectorizer as the notebook.
+    return: (fitted CountVectorizer, sparse int8 feature matrix)
+    params: search_terms (iterable of stemmed, lowercased names)
+    """
+    vectorizer = CountVectorizer(
+        max_features=5000,
+        stop_words='english',
+        dtype=np.int8
+    )
+    feature_matrix = vectorizer.fit_transform(search_terms)
+    return vectorizer, feature_matrix
+
+def build_top_neighbors_matrix(sim_matrix, k=10):
+    """
+    Notebook version over the dense similarity matrix, kept as the benchmark baseline.
+    return: np.array (N, k) int32
+    params: sim_matrix (dense N x N), k (int)
+    """
+    top_neighbors_list = []
+
+    for row_idx in range(sim_matrix.shape[0]):
+        sim_scores = list(enumerate(sim_matrix[row_idx]))
+        sim_scores_sorted = sorted(sim_scores, key=lambda x: x[1], reverse=True)
+        top_neighbors = sim_scores_sorted[1:k+1]
+        top_neighbors_indices = [item[0] for item in top_neighbors]
+        top_neighbors_list.append(top_neighbors_indices)
+
+    return np.array(top_neighbors_list, dtype=np.int32)
+
+def top_k_block(normalized, start, stop, k=10):
+    """
+    Top-k neighbors of the rows [start, stop).
+    return: (indices (B, k) int32, scores (B, k) float32), sorted by score and then by index
+    params: normalized (L2-normalized sparse CSR matrix), start (int), stop (int), k (int)
+    """
+    sims = (normalized[start:stop] @ normalized.T).toarray()
+    rows = np.arange(stop - start)
+    # Un producto no es vecino de sí mismo
+    sims[rows, rows + start] = -np.inf
+    top = np.argpartition(sims, -k, axis=1)[:, -k:]
+    # Empates en el k-ésimo lugar: quedarse con los de menor índice, como el sort estable del notebook
+    kth = np.take_along_axis(sims, top, axis=1).min(axis=1)
+    for row in np.flatnonzero((sims >= kth[:, None]).sum(axis=1) > k):
+        above = np.flatnonzero(sims[row] > kth[row])
+        equal = np.flatnonzero(sims[row] == kth[row])[:k - len(above)]
+        top[row] = np.concatenate((above, equal))
+    # Ordenar los k candidatos: mayor similitud primero y, a igualdad, menor índice
+    top.sort(axis=1)
+    top_scores = np.take_along_axis(sims, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    indices = np.take_along_axis(top, order, axis=1).astype(np.int32)
+    scores = np.take_along_axis(top_scores, order, axis=1).astype(np.float32)
+    return indices, scores
+
+def _init_worker(normalized):
+    _shared['normalized'] = normalized
+
+def _run_block(args):
+    start, stop, k = args
+    return top_k_block(_shared['normalized'], start, stop, k)
+
+def top_k_neighbors(feature_matrix, k=10, block_size=512, n_jobs=1, return_scores=False):
+    """
+    Top-k cosine neighbors of every row of a sparse feature matrix.
+    return: np.array (N, k) int32, and the (N, k) float32 scores if return_scores
+    params: feature_matrix (sparse N x V), k (int), block_size (rows per block), n_jobs (processes), return_scores (bool)
+    """
+    normalized = normalize(feature_matrix.astype(np.float32), norm='l2', copy=False).tocsr()
+    n = normalized.shape[0]
+    blocks = [(start, min(start + block_size, n), k) for start in range(0, n, block_size)]
+    if n_jobs > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(normalized,)) as pool:
+            results = pool.map(_run_block, blocks)
+    else:
+        results = [top_k_block(normalized, start, stop, k) for start, stop, k in blocks]
+    indices = np.concatenate([indices for indices, _ in results])
+    if return_scores:
+        return indices, np.concatenate([scores for _, scores in results])
+    return indices
+
+def benchmark(feature_matrix, k=10, n_rows=5000, block_size=512, n_jobs=1):
+    """
+    Compare the blocked top-k with the dense notebook pipeline on the first n_rows products.
+    return: dict with the timings and the share of identical neighbor lists
+    params: feature_matrix (sparse N x V), k (int), n_rows (int), block_size (int), n_jobs (int)
+    """
+    sample = feature_matrix[:n_rows]
+
+    start_time = time.time()
+    expected = build_top_neighbors_matrix(cosine_similarity(sample), k=k)
+    dense_time = time.time() - start_time
+
+    start_time = time.time()
+    indices = top_k_neighbors(sample, k=k, block_size=block_size, n_jobs=n_jobs)
+    sparse_time = time.time() - start_time
+
+    report = {
+        'rows': sample.shape[0],
+        'dense_sec': dense_time,
+        'blocked_sec': sparse_time,
+        'speedup': dense_time / sparse_time,
+        'dense_matrix_mb': sample.shape[0] ** 2 * 8 / 2 ** 20,
+        'block_matrix_mb': min(block_size, sample.shape[0]) * sample.shape[0] * 4 / 2 ** 20,
+        # El redondeo en float32 puede resolver distinto algunos casi-empates
+        'same_neighbors': float(np.mean(np.all(np.sort(expected, axis=1) == np.sort(indices, axis=1), axis=1))),
+    }
+    print(f"Dense cosine_similarity + sort: {report['dense_sec']:.3f} sec ({report['dense_matrix_mb']:.0f} MB matrix)")
+    print(f"Blocked sparse top-k: {report['blocked_sec']:.3f} sec ({report['block_matrix_mb']:.0f} MB per block)")
+    print(f"Speedup: {report['speedup']:.1f}x, identical neighbor lists: {report['same_neighbors']:.1%}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build top_k_neighbors.pkl from the notebook frame.')
+    parser.add_argument('frame', help='Pickled frame with the search_terms column')
+    parser.add_argument('--out', default='top_k_neighbors.pkl')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--benchmark', type=int, default=0, help='Compare with the dense pipeline on this many rows')
+    args = parser.parse_args()
+
+    frame = pd.read_pickle(args.frame)
+    _, feature_matrix = vectorize(frame['search_terms'])
+    print("Feature matrix shape:", feature_matrix.shape)
+
+    start_time = time.time()
+    top_k = top_k_neighbors(feature_matrix, k=args.k, block_size=args.block_size, n_jobs=args.jobs)
+    print(f"Time to build top-{args.k} neighbors structure: {time.time() - start_time:.3f} sec")
+    print("Shape of top_k_neighbors:", top_k.shape)
+
+    with open(args.out, 'wb') as f:
+        pickle.dump(top_k, f)
+    print(f"Saved {args.out}")
+
+    if args.benchmark:
+        benchmark(feature_matrix, k=args.k, n_rows=args.benchmark, block_size=args.block_size, n_jobs=args.jobs)
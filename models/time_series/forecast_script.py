@@ -1,4 +1,9 @@
 import os
+import sys
+import csv
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import warnings
 warnings.filterwarnings("ignore")
 import pandas as pd
@@ -13,15 +18,46 @@ from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score, m
 # Crear carpeta para guardar resultados
 os.makedirs('forecast', exist_ok=True)
 
+# Archivo de progreso del modo por lotes: una fila de métricas por serie terminada
+CHECKPOINT_FILE = 'forecast/metrics.csv'
+METRICS_COLUMNS = ['Store', 'Dept', 'RMSE', 'MAE', 'R2', 'MedAE', 'MAPE']
+
+# Datos cargados una sola vez en cada proceso del pool
+worker_data = {}
+
+# Indexar el dataset por (Store, Dept) en arreglos contiguos: cada serie es un slice ordenado por fecha
+def build_series_index(df):
+    store = df['Store'].to_numpy()
+    dept = df['Dept'].to_numpy()
+    dates = df['Date'].to_numpy()
+    order = np.lexsort((dates, dept, store))
+    store = store[order]
+    dept = dept[order]
+    starts = np.flatnonzero(np.r_[True, (store[1:] != store[:-1]) | (dept[1:] != dept[:-1])])
+    stops = np.r_[starts[1:], len(order)]
+    return {
+        'dates': dates[order],
+        # El test puede no tener ventas, solo fechas
+        'sales': df['Weekly_Sales'].to_numpy(dtype=np.float32)[order] if 'Weekly_Sales' in df.columns else None,
+        'slices': {(int(store[a]), int(dept[a])): (int(a), int(b)) for a, b in zip(starts, stops)},
+    }
+
+# Obtener las fechas y ventas de una tienda y departamento (vistas, sin copiar)
+def get_series(index, store, dept):
+    bounds = index['slices'].get((store, dept))
+    if bounds is None:
+        return None, None
+    start, stop = bounds
+    sales = index['sales'][start:stop] if index['sales'] is not None else None
+    return index['dates'][start:stop], sales
+
 # Cargar y preparar datasets
 def load_data():
     df_train = pd.read_csv('data/processed/cleaned_data.csv')
     df_train['Date'] = pd.to_datetime(df_train['Date'])
-    df_train.sort_values('Date', inplace=True)
     df_test = pd.read_csv('data/processed/cleaned_test_data.csv')
     df_test['Date'] = pd.to_datetime(df_test['Date'])
-    df_test.sort_values('Date', inplace=True)
-    return df_train, df_test
+    return build_series_index(df_train), build_series_index(df_test)
 
 # Convertir la serie escalada en secuencias de ventanas (X, y)
 def create_dataset(data, window_size=4):
@@ -32,10 +68,9 @@ def create_dataset(data, window_size=4):
     return np.array(X), np.array(y)
 
 # Construir y entrenar el modelo LSTM en los datos de entrenamiento
-def build_and_train_model(train_data, window_size=4, epochs=50, batch_size=32):
+def build_and_train_model(sales, window_size=4, epochs=50, batch_size=32):
     scaler = MinMaxScaler()
-    sales = train_data['Weekly_Sales'].values.reshape(-1, 1)
-    sales_scaled = scaler.fit_transform(sales)
+    sales_scaled = scaler.fit_transform(sales.reshape(-1, 1))
     X, y_seq = create_dataset(sales_scaled, window_size)
     model = Sequential()
     model.add(LSTM(50, activation='relu', input_shape=(window_size, 1)))
@@ -45,34 +80,43 @@ def build_and_train_model(train_data, window_size=4, epochs=50, batch_size=32):
     model.fit(X, y_seq, epochs=epochs, batch_size=batch_size, verbose=0)
     return model, scaler, sales_scaled
 
+# Predicción recursiva por lotes: avanza todas las series a la vez con una sola llamada al modelo por paso
+def recursive_forecast(model, windows, n_forecast=30):
+    """
+    Forecast n_forecast steps ahead for a batch of series.
+    return: np.array (n_series, n_forecast) in the scaled space
+    params: model (keras model), windows (array (n_series, window_size, 1) with the last scaled values of each series), n_forecast (int)
+    """
+    n_series, window_size, _ = windows.shape
+    # Buffer preasignado: ventana inicial seguida de las predicciones, la ventana de cada paso es una vista
+    buffer = np.empty((n_series, window_size + n_forecast, 1), dtype=np.float32)
+    buffer[:, :window_size] = windows
+    for t in range(n_forecast):
+        pred_scaled = model(buffer[:, t:t + window_size], training=False)
+        buffer[:, window_size + t] = np.asarray(pred_scaled)
+    return buffer[:, window_size:, 0]
+
 # Realizar la predicción recursiva de los siguientes períodos
 def forecast_series(model, scaler, sales_scaled, window_size=4, n_forecast=30):
-    current_sequence = sales_scaled[-window_size:].copy()
-    forecast_scaled = []
-    for _ in range(n_forecast):
-        input_seq = current_sequence.reshape(1, window_size, 1)
-        pred_scaled = model.predict(input_seq, verbose=0)
-        forecast_scaled.append(pred_scaled[0, 0])
-        current_sequence = np.append(current_sequence[1:], [[pred_scaled[0, 0]]], axis=0)
-    forecast_full = scaler.inverse_transform(np.array(forecast_scaled).reshape(-1, 1))
+    current_sequence = sales_scaled[-window_size:].reshape(1, window_size, 1)
+    forecast_scaled = recursive_forecast(model, current_sequence, n_forecast=n_forecast)
+    forecast_full = scaler.inverse_transform(forecast_scaled.reshape(-1, 1))
     return forecast_full
 
 # Obtener las fechas del primer mes de predicción a partir del test
-def get_forecast_dates(test_data):
-    test_data = test_data.copy()
-    test_data.sort_values('Date', inplace=True)
-    all_forecast_dates = test_data['Date'].reset_index(drop=True)
+def get_forecast_dates(test_dates):
+    all_forecast_dates = pd.Series(test_dates)
     first_forecast_date = all_forecast_dates.iloc[0]
     mask_first_month = (all_forecast_dates.dt.month == first_forecast_date.month) & (all_forecast_dates.dt.year == first_forecast_date.year)
     forecast_dates_first_month = all_forecast_dates[mask_first_month].reset_index(drop=True)
     return forecast_dates_first_month
 
 # Obtener los últimos días reales del conjunto de entrenamiento
-def get_actual_last(train_data, days=120):
-    last_train_date = train_data['Date'].max()
-    start_date = last_train_date - pd.Timedelta(days=days)
-    actual_last = train_data[train_data['Date'] >= start_date][['Date', 'Weekly_Sales']].copy()
-    actual_last.rename(columns={'Weekly_Sales': 'Sales'}, inplace=True)
+def get_actual_last(dates, sales, days=120):
+    # Las fechas están ordenadas: búsqueda binaria del inicio del período
+    start_date = dates[-1] - np.timedelta64(days, 'D')
+    start = np.searchsorted(dates, start_date, side='left')
+    actual_last = pd.DataFrame({'Date': dates[start:], 'Sales': sales[start:]})
     return actual_last
 
 # Graficar el forecast y guardar la imagen
@@ -97,79 +141,29 @@ def plot_forecast(actual_last, forecast_df, store, dept, forecast_color='tab:blu
 
 # Función para generar predicciones in-sample en el conjunto de entrenamiento
 def forecast_on_train(model, scaler, sales_scaled, window_size=4):
-    predictions = []
-    for i in range(window_size, len(sales_scaled)):
-        input_seq = sales_scaled[i-window_size:i].reshape(1, window_size, 1)
-        pred_scaled = model.predict(input_seq, verbose=0)
-        predictions.append(pred_scaled[0, 0])
-    predictions = np.array(predictions).reshape(-1, 1)
-    predictions_inverted = scaler.inverse_transform(predictions)
+    # Todas las ventanas del entrenamiento en un solo lote
+    windows = np.lib.stride_tricks.sliding_window_view(sales_scaled[:-1, 0], window_size)
+    pred_scaled = model(windows.reshape(-1, window_size, 1).astype(np.float32), training=False)
+    predictions_inverted = scaler.inverse_transform(np.asarray(pred_scaled).reshape(-1, 1))
     return predictions_inverted
 
 # Graficar las predicciones in-sample junto con los datos reales del entrenamiento
-def plot_train_predictions(train_data, predictions, window_size=4):
-    actual = train_data['Weekly_Sales'].values[window_size:]
-    dates = train_data['Date'].values[window_size:]
+def plot_train_predictions(dates, sales, predictions, window_size=4, plot_filename="forecast/train_in_sample_predictions.png"):
     plt.figure(figsize=(12,6))
-    plt.plot(train_data['Date'], train_data['Weekly_Sales'], label="Ventas Reales", marker='o', linestyle='-')
-    plt.plot(dates, predictions, label="Predicción In-Sample", marker='x', linestyle='--')
+    plt.plot(dates, sales, label="Ventas Reales", marker='o', linestyle='-')
+    plt.plot(dates[window_size:], predictions, label="Predicción In-Sample", marker='x', linestyle='--')
     plt.title("Predicción In-Sample (Entrenamiento)")
     plt.xlabel("Fecha")
     plt.ylabel("Ventas Semanales")
     plt.legend()
     plt.grid(True)
     plt.tight_layout()
-    plot_filename = "forecast/train_in_sample_predictions.png"
     plt.savefig(plot_filename)
     plt.close()
     print(f"Guardado gráfico de predicciones in-sample en: {plot_filename}")
 
-# Procesar y generar el forecast para una tienda y departamento dados
-def process_forecast(store, dept, df_train, df_test, window_size=4, n_forecast=30):
-    train_data = df_train[(df_train['Store'] == store) & (df_train['Dept'] == dept)].copy()
-    train_data.sort_values('Date', inplace=True)
-    if len(train_data) < window_size + 1:
-        print(f"Datos insuficientes para Store {store} Dept {dept}.")
-        return None, None
-    model, scaler, sales_scaled = build_and_train_model(train_data, window_size=window_size)
-    forecast_full = forecast_series(model, scaler, sales_scaled, window_size=window_size, n_forecast=n_forecast)
-    test_data = df_test[(df_test['Store'] == store) & (df_test['Dept'] == dept)].copy()
-    test_data.sort_values('Date', inplace=True)
-    if test_data.empty:
-        print(f"No hay datos de test para Store {store} Dept {dept}.")
-        return None, None
-    forecast_dates_first_month = get_forecast_dates(test_data)
-    n_first_month = len(forecast_dates_first_month)
-    forecast_first_month = forecast_full[:n_first_month]
-    forecast_df = pd.DataFrame({'Date': forecast_dates_first_month, 'Sales': forecast_first_month.flatten()})
-    actual_last = get_actual_last(train_data, days=120)
-    combined_df = pd.concat([actual_last, forecast_df], ignore_index=True)
-    plot_filename = plot_forecast(actual_last, forecast_df, store, dept, forecast_color='tab:blue')
-    csv_filename = f"forecast/store_{store}_dept_{dept}.csv"
-    combined_df.to_csv(csv_filename, index=False)
-    print(f"Guardado gráfico en: {plot_filename}")
-    print(f"Guardado dataframe en: {csv_filename}")
-    return combined_df, plot_filename
-
-# Evaluar el modelo utilizando parte de los datos de entrenamiento (RMSE, MAE, R2, MedAE, MAPE)
-def evaluate_model(train_data, window_size=4, n_forecast=30, epochs=50, batch_size=32):
-    if len(train_data) < window_size + n_forecast:
-        print("Datos insuficientes para evaluación.")
-        return None
-    train_train = train_data.iloc[:-(n_forecast)]
-    eval_data = train_data.iloc[-(window_size+n_forecast):].copy()
-    model, scaler, _ = build_and_train_model(train_train, window_size=window_size, epochs=epochs, batch_size=batch_size)
-    sales_eval = eval_data['Weekly_Sales'].values.reshape(-1, 1)
-    sales_scaled_eval = scaler.transform(sales_eval)
-    forecast_scaled = []
-    current_sequence = sales_scaled_eval[:window_size].copy()
-    for _ in range(n_forecast):
-        input_seq = current_sequence.reshape(1, window_size, 1)
-        pred_scaled = model.predict(input_seq, verbose=0)
-        forecast_scaled.append(pred_scaled[0, 0])
-        current_sequence = np.append(current_sequence[1:], [[pred_scaled[0, 0]]], axis=0)
-    forecast_eval = scaler.inverse_transform(np.array(forecast_scaled).reshape(-1, 1))
-    actual_eval = sales_eval[window_size:]
+# Calcular las métricas de evaluación (RMSE, MAE, R2, MedAE, MAPE)
+def compute_metrics(actual_eval, forecast_eval):
     mse = mean_squared_error(actual_eval, forecast_eval)
     rmse = np.sqrt(mse)
     mae = mean_absolute_error(actual_eval, forecast_eval)
@@ -178,44 +172,127 @@ def evaluate_model(train_data, window_size=4, n_forecast=30, epochs=50, batch_si
     mape = mean_absolute_percentage_error(actual_eval, forecast_eval)
     return rmse, mae, r2, medae, mape
 
+# Evaluar con un modelo entrenado sin los últimos n_forecast valores; el forecast y las predicciones in-sample
+# usan un modelo final entrenado con la serie completa (con single_model=True se reutiliza el de evaluación)
+def process_series(store, dept, train_index, test_index, window_size=4, n_forecast=30, epochs=50, plots=False, single_model=False):
+    dates, sales = get_series(train_index, store, dept)
+    if sales is None or len(sales) < window_size + 1:
+        print(f"Datos insuficientes para Store {store} Dept {dept}.")
+        return None
+    # Si la serie alcanza, se entrena sin los últimos n_forecast valores para poder evaluar sobre ellos
+    evaluate = len(sales) >= window_size + n_forecast + 1
+    sales_fit = sales[:-(n_forecast)] if evaluate else sales
+    model, scaler, _ = build_and_train_model(sales_fit, window_size=window_size, epochs=epochs)
+    sales_scaled = scaler.transform(sales.reshape(-1, 1))
+
+    metrics_dict = {"Store": store, "Dept": dept}
+    if evaluate:
+        current_sequence = sales_scaled[-(window_size+n_forecast):-(n_forecast)].reshape(1, window_size, 1)
+        forecast_scaled = recursive_forecast(model, current_sequence, n_forecast=n_forecast)
+        forecast_eval = scaler.inverse_transform(forecast_scaled.reshape(-1, 1))
+        metrics = compute_metrics(sales[-(n_forecast):].reshape(-1, 1), forecast_eval)
+        metrics_dict.update(zip(METRICS_COLUMNS[2:], metrics))
+        if not single_model:
+            # Modelo final con la serie completa, como el que se despliega
+            model, scaler, sales_scaled = build_and_train_model(sales, window_size=window_size, epochs=epochs)
+
+    # Forecast fuera de muestra desde el final de la serie completa
+    forecast_full = forecast_series(model, scaler, sales_scaled, window_size=window_size, n_forecast=n_forecast)
+    actual_last = get_actual_last(dates, sales, days=120)
+    test_dates, _ = get_series(test_index, store, dept)
+    if test_dates is not None:
+        forecast_dates_first_month = get_forecast_dates(test_dates)
+        forecast_df = pd.DataFrame({'Date': forecast_dates_first_month, 'Sales': forecast_full[:len(forecast_dates_first_month)].flatten()})
+        combined_df = pd.concat([actual_last, forecast_df], ignore_index=True)
+        combined_df.to_csv(f"forecast/store_{store}_dept_{dept}.csv", index=False)
+        if plots:
+            plot_forecast(actual_last, forecast_df, store, dept, forecast_color='tab:blue')
+
+    # Predicciones in-sample con el mismo modelo que el forecast
+    train_predictions = forecast_on_train(model, scaler, sales_scaled, window_size=window_size)
+    pd.DataFrame({'Date': dates[window_size:], 'Sales': sales[window_size:], 'Prediction': train_predictions.flatten()}).to_csv(
+        f"forecast/in_sample_store_{store}_dept_{dept}.csv", index=False)
+    if plots:
+        plot_train_predictions(dates, sales, train_predictions, window_size=window_size,
+                               plot_filename=f"forecast/in_sample_store_{store}_dept_{dept}.png")
+    return metrics_dict
+
+# Inicializar cada proceso del pool: fijar los hilos de TensorFlow y cargar los datos una sola vez
+def init_worker(intra_threads, inter_threads):
+    tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    worker_data['train_index'], worker_data['test_index'] = load_data()
+
+def run_worker(store, dept, window_size, n_forecast, epochs, plots, single_model):
+    return process_series(store, dept, worker_data['train_index'], worker_data['test_index'],
+                          window_size=window_size, n_forecast=n_forecast, epochs=epochs, plots=plots, single_model=single_model)
+
+# Leer las series ya terminadas de una ejecución anterior
+def load_checkpoint(checkpoint_file=CHECKPOINT_FILE):
+    if not os.path.exists(checkpoint_file):
+        return set()
+    done = pd.read_csv(checkpoint_file, usecols=['Store', 'Dept'])
+    return set(zip(done['Store'].astype(int), done['Dept'].astype(int)))
+
+# Entrenar y evaluar todas las series en paralelo, guardando el progreso a medida que terminan
+def run_batch(pairs, workers, intra_threads=1, inter_threads=1, window_size=4, n_forecast=30, epochs=50, plots=False, single_model=False, checkpoint_file=CHECKPOINT_FILE):
+    done = load_checkpoint(checkpoint_file)
+    pending = [pair for pair in pairs if pair not in done]
+    print(f"{len(done)} series ya procesadas, {len(pending)} pendientes.")
+    if not pending:
+        return
+
+    new_file = not os.path.exists(checkpoint_file)
+    # 'spawn': cada proceso inicia TensorFlow con sus propios hilos
+    context = multiprocessing.get_context('spawn')
+    with open(checkpoint_file, 'a', newline='') as f, ProcessPoolExecutor(
+            max_workers=workers, mp_context=context, initializer=init_worker,
+            initargs=(intra_threads, inter_threads)) as executor:
+        writer = csv.DictWriter(f, fieldnames=METRICS_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        futures = {executor.submit(run_worker, store, dept, window_size, n_forecast, epochs, plots, single_model): (store, dept)
+                   for store, dept in pending}
+        for i, future in enumerate(as_completed(futures), start=1):
+            store, dept = futures[future]
+            try:
+                metrics_dict = future.result()
+            except Exception as e:
+                # La serie no se marca como terminada y se reintenta en la próxima ejecución
+                print(f"Error en Store {store} Dept {dept}: {e}")
+                continue
+            # Las series sin datos suficientes también se marcan, con métricas vacías
+            writer.writerow(metrics_dict or {"Store": store, "Dept": dept})
+            f.flush()
+            print(f"[{i}/{len(pending)}] Store {store} Dept {dept} terminado.")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Entrenar y evaluar el modelo LSTM para cada tienda y departamento.")
+    parser.add_argument("--store", type=int, help="Procesar solo esta tienda")
+    parser.add_argument("--dept", type=int, help="Procesar solo este departamento")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Número de procesos")
+    parser.add_argument("--intra-threads", type=int, default=1, help="Hilos intra-op de TensorFlow por proceso")
+    parser.add_argument("--inter-threads", type=int, default=1, help="Hilos inter-op de TensorFlow por proceso")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--plots", action="store_true", help="Guardar también los gráficos de cada serie")
+    parser.add_argument("--single-model", action="store_true",
+                        help="Reutilizar el modelo de evaluación para el forecast (la mitad de entrenamientos, sin los últimos 30 períodos)")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="CSV de métricas usado para reanudar")
+    args = parser.parse_args()
     window_size = 4
     n_forecast = 30
-    store_input = input("Ingrese el número de tienda: ")
-    dept_input = input("Ingrese el número de departamento: ")
-    try:
-        store = int(store_input)
-        dept = int(dept_input)
-    except ValueError:
-        print("Entrada inválida. Se requieren números enteros.")
-        exit(1)
-    df_train, df_test = load_data()
-    process_forecast(store, dept, df_train, df_test, window_size=window_size, n_forecast=n_forecast)
-    train_data = df_train[(df_train['Store'] == store) & (df_train['Dept'] == dept)].copy()
-    metrics = evaluate_model(train_data, window_size=window_size, n_forecast=n_forecast)
-    if metrics is not None:
-        rmse, mae, r2, medae, mape = metrics
-        print("Métricas de Evaluación:")
-        print(f" - RMSE: {rmse:.2f}")
-        print(f" - MAE: {mae:.2f}")
-        print(f" - R²: {r2:.2f}")
-        print(f" - MedAE: {medae:.2f}")
-        print(f" - MAPE: {mape*100:.2f}%")
-        # Guardar métricas en CSV
-        metrics_dict = {
-            "Store": store,
-            "Dept": dept,
-            "RMSE": rmse,
-            "MAE": mae,
-            "R2": r2,
-            "MedAE": medae,
-            "MAPE": mape
-        }
-        metrics_df = pd.DataFrame([metrics_dict])
-        metrics_csv_filename = f"forecast/metrics_store_{store}_dept_{dept}.csv"
-        metrics_df.to_csv(metrics_csv_filename, index=False)
-        print(f"Guardadas métricas en: {metrics_csv_filename}")
-    # Generar y graficar predicciones in-sample para el conjunto de entrenamiento
-    model, scaler, sales_scaled = build_and_train_model(train_data, window_size=window_size)
-    train_predictions = forecast_on_train(model, scaler, sales_scaled, window_size=window_size)
-    plot_train_predictions(train_data, train_predictions, window_size=window_size)
+
+    train_index, _ = load_data()
+    pairs = sorted(train_index['slices'])
+    if args.store is not None:
+        pairs = [pair for pair in pairs if pair[0] == args.store]
+    if args.dept is not None:
+        pairs = [pair for pair in pairs if pair[1] == args.dept]
+    if not pairs:
+        print("No hay series para la tienda y departamento indicados.")
+        sys.exit(1)
+
+    run_batch(pairs, args.workers, intra_threads=args.intra_threads, inter_threads=args.inter_threads,
+              window_size=window_size, n_forecast=n_forecast, epochs=args.epochs, plots=args.plots, single_model=args.single_model,
+              checkpoint_file=args.checkpoint)
+    print(f"Guardadas métricas en: {args.checkpoint}")